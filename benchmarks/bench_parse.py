@@ -0,0 +1,121 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+from project.server.main import aurehal as aurehal_module
+from project.server.main import parse as parse_module
+from project.server.main.aurehal import AurehalMap, create_docid_map, parse_author, parse_structure
+from project.server.main.parse import get_repository, normalize, parse_date_cached, parse_hal, parse_hal_chunk
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+SNAPSHOT_DATE = '20240101'
+RECORDED_ROUNDS = 200
+MIN_SECONDS = 0.2
+
+
+def load_fixture(name):
+    with gzip.open(os.path.join(FIXTURES_DIR, f'{name}.json.gz'), 'rt') as f:
+        return json.load(f)
+
+
+def clear_caches():
+    # every repetition starts cold, so that timings do not depend on the previous one
+    normalize.cache_clear()
+    get_repository.cache_clear()
+    parse_date_cached.cache_clear()
+
+
+def get_benchmarks():
+    notices = load_fixture('hal_notices')
+    recorded_notices = load_fixture('hal_recorded')
+    structures = load_fixture('aurehal_structure')
+    authors = load_fixture('aurehal_author')
+    _, structure_docids = create_docid_map(structures, 'structure', {})
+    _, author_docids = create_docid_map(authors, 'author', {})
+    # the maps are built once, outside of the timed functions: parse_hal only annotates copies of their entities
+    aurehal = {'structure': AurehalMap([parse_structure(s) for s in structures], structure_docids),
+               'author': AurehalMap([parse_author(a, {}) for a in authors], author_docids)}
+
+    texts = [t for n in notices for t in n.get('title_s', []) + n.get('authFullName_s', [])]
+    urls = [n['linkExtUrl_s'] for n in notices if isinstance(n.get('linkExtUrl_s'), str)]
+    return {
+        'parse_hal': (len(notices), lambda: [parse_hal(n, aurehal, SNAPSHOT_DATE) for n in notices]),
+        # the few notices recorded as is from HAL are parsed over and over, for a timing above the noise
+        'parse_hal_recorded': (len(recorded_notices) * RECORDED_ROUNDS,
+                               lambda: [parse_hal(n, aurehal, SNAPSHOT_DATE) for _ in range(RECORDED_ROUNDS) for n in recorded_notices]),
+        # the production path, in process (the parse pool only spreads the same work over processes)
+        'parse_hal_chunk': (len(notices), lambda: parse_hal_chunk(notices, aurehal, SNAPSHOT_DATE)),
+        'parse_structure': (len(structures), lambda: [parse_structure(s) for s in structures]),
+        'parse_author': (len(authors), lambda: [parse_author(a, {}) for a in authors]),
+        'create_docid_map': (len(structures) + len(authors),
+                             lambda: (create_docid_map(structures, 'structure', {}), create_docid_map(authors, 'author', {}))),
+        'normalize': (len(texts), lambda: [normalize(t, 1) for t in texts]),
+        'get_repository': (len(urls), lambda: [get_repository(u) for u in urls]),
+    }
+
+
+def run_benchmarks(repeat):
+    results = {}
+    for name, (nb_docs, func) in get_benchmarks().items():
+        timings = []
+        for _ in range(repeat):
+            # the fastest functions are run several times in a row, for timings above the noise of the machine
+            nb_runs, seconds = 0, 0
+            while nb_runs == 0 or seconds < MIN_SECONDS:
+                clear_caches()
+                start = time.perf_counter()
+                func()
+                seconds += time.perf_counter() - start
+                nb_runs += 1
+            timings.append(seconds / nb_runs)
+        clear_caches()
+        tracemalloc.start()
+        func()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        best = min(timings)
+        results[name] = {'nb_docs': nb_docs, 'seconds': round(best, 6), 'docs_per_sec': round(nb_docs / best, 1),
+                         'peak_memory_kb': round(peak_memory / 1024, 1)}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # a benchmark regresses when its throughput drops by more than tolerance
+    regressions = []
+    for name, res in results.items():
+        if name not in baseline:
+            continue
+        ratio = res['docs_per_sec'] / baseline[name]['docs_per_sec']
+        status = 'ok'
+        if ratio < 1 - tolerance:
+            status = 'REGRESSION'
+            regressions.append(name)
+        print(f"{name:<20} {baseline[name]['docs_per_sec']:>12} -> {res['docs_per_sec']:>12} docs/sec ({ratio:.2f}x) {status}")
+    return regressions
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Offline benchmark of the HAL and AureHAL parsers')
+    argparser.add_argument('--repeat', type=int, default=5)
+    argparser.add_argument('--save', help='write the results to this baseline file')
+    argparser.add_argument('--compare', help='fail if throughput dropped compared to this baseline file')
+    argparser.add_argument('--tolerance', type=float, default=0.2)
+    args = argparser.parse_args()
+    for module in [aurehal_module, parse_module]:
+        module.logger.setLevel(logging.WARNING)
+    results = run_benchmarks(args.repeat)
+    print(f"{'function':<20} {'docs':>8} {'seconds':>10} {'docs/sec':>12} {'peak KB':>10}")
+    for name, res in results.items():
+        print(f"{name:<20} {res['nb_docs']:>8} {res['seconds']:>10} {res['docs_per_sec']:>12} {res['peak_memory_kb']:>10}")
+    if args.save:
+        json.dump(results, open(args.save, 'w'), indent=2)
+    if args.compare:
+        regressions = compare(results, json.load(open(args.compare, 'r')), args.tolerance)
+        if regressions:
+            print(f'regressions : {regressions}')
+            sys.exit(1)
@@ -0,0 +1,147 @@
+import argparse
+import copy
+import gzip
+import json
+import os
+import random
+import requests
+
+from project.server.main.fields import AUREHAL_FIELDS, HAL_FIELDS, get_fl
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+HAL_URL = 'https://api.archives-ouvertes.fr'
+
+
+def save_fixture(data, name):
+    with gzip.open(os.path.join(FIXTURES_DIR, f'{name}.json.gz'), 'wt') as f:
+        json.dump(data, f)
+    print(f'{name} : {len(data)} records')
+
+
+def get_docs(url):
+    r = requests.get(url, timeout=100)
+    r.raise_for_status()
+    return r.json()['response']['docs']
+
+
+def record(nb_notices, seed):
+    # a random slice of HAL, and the referential records its notices point to
+    start = random.Random(seed).randint(0, 1000000)
+    notices = []
+    while len(notices) < nb_notices:
+        rows = min(1000, nb_notices - len(notices))
+        notices += get_docs(f'{HAL_URL}/search/?q=*:*&wt=json&fl={get_fl(HAL_FIELDS)}&sort=docid asc&rows={rows}&start={start + len(notices)}')
+    struct_ids = sorted(set([str(s) for n in notices for s in n.get('structId_i', [])]))
+    author_ids = sorted(set([a for n in notices for a in n.get('authIdFormPerson_s', [])]))
+    referentials = {'structure': struct_ids, 'author': author_ids}
+    for aurehal_type, ids in referentials.items():
+        records = []
+        for ix in range(0, len(ids), 100):
+            query = ' OR '.join([f'"{i}"' for i in ids[ix:ix + 100]])
+            records += get_docs(f'{HAL_URL}/ref/{aurehal_type}/?q=docid:({query})&wt=json&fl={get_fl(AUREHAL_FIELDS[aurehal_type])}&rows=100')
+        referentials[aurehal_type] = records
+    return notices, referentials['structure'], referentials['author']
+
+
+FIRST_NAMES = ['Marie', 'Jean', 'Pierre', 'Anne', 'Michel', 'Sophie', 'Nicolas', 'Isabelle', 'Laurent', 'Julie', 'Wei', 'Maria',
+               'José', 'Élodie', 'Jürgen', 'A.', 'J.-C.']
+LAST_NAMES = ['Martin', 'Bernard', 'Dubois', 'Thomas', 'Robert', 'Richard', 'Petit', 'Durand', 'Leroy', 'Moreau', 'Wang',
+              'Garcia', 'Müller', 'Nguyen Ba An', 'Godrèche', "O'Neil"]
+LAB_NAMES = ['Laboratoire de Physique', 'Institut de Chimie', 'Centre de Recherche en Informatique', 'Unité de Biologie',
+             'Laboratoire de Mathématiques', 'Institut des Sciences Humaines', 'Observatoire']
+COUNTRIES = ['fr', 'fr', 'fr', 'de', 'us', 'gb', 'it', 'es', 'xx']
+LINK_URLS = ['https://arxiv.org/abs/2101.00001', 'https://www.biorxiv.org/content/10.1101/2020.01.01', 'https://europepmc.org/abstract/MED/1',
+             'https://www.ncbi.nlm.nih.gov/pmc/articles/PMC1', 'https://zenodo.org/record/1', 'https://doi.org/10.1000/xyz',
+             'https://lirias.kuleuven.be/1', 'https://www.osti.gov/biblio/1', 'https://example.org/paper.pdf',
+             'https://hal.science/hal-00000001']
+DOC_TYPES = ['ART', 'ART', 'ART', 'COMM', 'OUV', 'DOUV', 'COUV', 'THESE', 'PROCEEDINGS', 'POSTER', 'UNDEFINED']
+
+
+def derive(sample_file, nb_notices, seed):
+    # a larger sample built around real raw notices, for when the HAL API cannot be reached;
+    # authors, structures, dates and links are varied so that every branch of the parsers is exercised
+    rand = random.Random(seed)
+    base = [{k: v for k, v in n.items() if k in HAL_FIELDS} for n in json.load(open(sample_file, 'r'))]
+    structures = []
+    for ix in range(max(10, nb_notices // 10)):
+        structure = {'docid': 100000 + ix, 'name_s': rand.choice(LAB_NAMES), 'acronym_s': f'L{ix}', 'country_s': rand.choice(COUNTRIES)}
+        if rand.random() < 0.5:
+            structure['aliasDocid_i'] = [200000 + ix]
+        if rand.random() < 0.5:
+            structure['parentName_s'] = ['CNRS', rand.choice(LAB_NAMES)]
+        if rand.random() < 0.5:
+            structure['address_s'] = f'{ix} rue de la Recherche'
+        if rand.random() < 0.3:
+            structure['rnsr_s'] = [f'2000{ix:05d}X']
+        if rand.random() < 0.3:
+            structure['ror_s'] = [f'https://ror.org/0{ix:07d}']
+        structures.append(structure)
+    authors = []
+    for ix in range(max(10, nb_notices)):
+        person_id = 0 if rand.random() < 0.3 else 500000 + ix
+        author = {'docid': f'{300000 + ix}-{person_id}', 'firstName_s': rand.choice(FIRST_NAMES), 'lastName_s': rand.choice(LAST_NAMES)}
+        author['fullName_s'] = f"{author['firstName_s']} {author['lastName_s']}"
+        if person_id:
+            author['person_i'] = person_id
+            author['idHal_i'] = person_id
+            author['idHal_s'] = f'person-{person_id}'
+        if rand.random() < 0.3:
+            author['orcidId_s'] = [f'https://orcid.org/0000-0002-{ix:04d}-0000']
+        if rand.random() < 0.2:
+            author['idrefId_s'] = [f'https://www.idref.fr/0{ix:08d}']
+        if rand.random() < 0.3:
+            author['emailDomain_s'] = 'univ.fr'
+        authors.append(author)
+    notices = []
+    for ix in range(nb_notices):
+        notice = copy.deepcopy(base[ix % len(base)])
+        notice['docid'] = 1000000 + ix
+        notice['halId_s'] = f'hal-{notice["docid"]:08d}'
+        notice['doiId_s'] = f'10.1000/HAL.{ix}'
+        notice['docType_s'] = rand.choice(DOC_TYPES)
+        notice['proceedings_s'] = rand.choice(['0', '1'])
+        year = rand.randint(1950, 2024)
+        date = rand.choice([f'{year}', f'{year}-{rand.randint(1, 12):02d}', f'{year}-{rand.randint(1, 12):02d}-{rand.randint(1, 28):02d}',
+                            f'{year}-02-30', 'unknown'])
+        notice['publicationDate_s'] = date
+        notice['producedDate_s'] = str(year)
+        notice_authors = rand.sample(authors, rand.randint(1, 8))
+        notice_structures = rand.sample(structures, rand.randint(1, 4))
+        auth_ids = [a['docid'] for a in notice_authors]
+        if rand.random() < 0.1:
+            auth_ids[-1] = f'{900000 + ix}-0'
+        notice['authIdFormPerson_s'] = auth_ids
+        notice['authFullName_s'] = [a['fullName_s'] for a in notice_authors]
+        notice['authFirstName_s'] = [a['firstName_s'] for a in notice_authors]
+        notice['authLastName_s'] = [a['lastName_s'] for a in notice_authors]
+        notice['authQuality_s'] = [rand.choice(['aut', 'aut', 'crp']) for _ in notice_authors]
+        notice['structId_i'] = [s['docid'] for s in notice_structures]
+        notice['authIdHasStructure_fs'] = [f"{a}_FacetSep_{n}_JoinSep_{s['docid']}_FacetSep_{s['name_s']}"
+                                           for a, n in zip(auth_ids, notice['authFullName_s']) for s in notice_structures[0:2]]
+        notice['submitType_s'] = rand.choice(['file', 'notice', 'notice'])
+        notice['openAccess_bool'] = rand.random() < 0.7
+        notice['linkExtUrl_s'] = rand.choice(LINK_URLS)
+        notice['licence_s'] = rand.choice(['http://creativecommons.org/licenses/by/', None])
+        notice['anrProjectReference_s'] = [f'ANR-{ix}'] if rand.random() < 0.2 else None
+        notice = {k: v for k, v in notice.items() if v is not None}
+        notices.append(notice)
+    return notices, structures, authors
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Record the HAL notices and AureHAL records used by the benchmarks')
+    argparser.add_argument('--nb-notices', type=int, default=2000)
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument('--derive', help='build the fixtures from a local sample of raw notices instead of the HAL API')
+    args = argparser.parse_args()
+    if args.derive:
+        notices, structures, authors = derive(args.derive, args.nb_notices, args.seed)
+        recorded = [{k: v for k, v in n.items() if k in HAL_FIELDS} for n in json.load(open(args.derive, 'r'))]
+    else:
+        notices, structures, authors = record(args.nb_notices, args.seed)
+        recorded = notices
+    # the notices as returned by the HAL API, without any derived field
+    save_fixture(recorded, 'hal_recorded')
+    save_fixture(notices, 'hal_notices')
+    save_fixture(structures, 'aurehal_structure')
+    save_fixture(authors, 'aurehal_author')
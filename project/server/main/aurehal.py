@@ -1,38 +1,91 @@
+import datetime
+import gzip
+import hashlib
+import json
 import os
 import requests
-import json
 import pycountry
 import pandas as pd
+import sqlite3
+import tempfile
+import threading
+from functools import lru_cache
 from retry import retry
-from project.server.main.utils_swift import upload_object, download_object
+from project.server.main.utils_swift import download_object, get_etag, get_json_object, iter_json, submit_upload, upload_json, upload_object
+from project.server.main.fields import AUREHAL_FIELDS, STRUCTURE_NAME_FIELDS, get_fl
 from project.server.main.idref import update_vip
+from project.server.main.rate_limiter import hal_rate_limiter
 from urllib.parse import quote_plus
 from project.server.main.logger import get_logger
 
 logger = get_logger(__name__)
 
+AUREHAL_CACHE_SIZE = int(os.getenv('AUREHAL_CACHE_SIZE', 100000))
+AUREHAL_MMAP_SIZE = int(os.getenv('AUREHAL_MMAP_SIZE', 8 * 1024 * 1024 * 1024))
+AUREHAL_TIMEOUT = int(os.getenv('AUREHAL_TIMEOUT', 300))
+AUREHAL_PAGE_TRIES = int(os.getenv('AUREHAL_PAGE_TRIES', 10))
+AUREHAL_RETRY_DELAY = int(os.getenv('AUREHAL_RETRY_DELAY', 10))
+AUREHAL_UPDATE_DATE = os.getenv('AUREHAL_UPDATE_DATE', 'updateDate_tdate')
+AUREHAL_SNAPSHOTS = 'aurehal_snapshots'
+
 country_code_to_name = {}
 for c in list(pycountry.countries):
     country_code = c.alpha_2.lower()
     country_code_to_name[country_code] = c.name
 
-@retry(delay=200, tries=10)
-def get_aurehal(aurehal_type):
-    logger.debug(f'start {aurehal_type} aurehal')
+@retry(delay=AUREHAL_RETRY_DELAY, backoff=2, max_delay=600, tries=AUREHAL_PAGE_TRIES, logger=logger)
+def get_aurehal_page(aurehal_type, query, fl, nb_rows, cursor):
+    url = f'https://api.archives-ouvertes.fr/ref/{aurehal_type}/?q={query}&wt=json&fl={fl}&sort=docid asc&rows={nb_rows}&cursorMark={cursor}'
+    hal_rate_limiter.wait()
+    r = requests.get(url, timeout=AUREHAL_TIMEOUT)
+    r.raise_for_status()
+    res = r.json()
+    return res['response']['docs'], quote_plus(res['nextCursorMark'])
+
+def get_spill_name(aurehal_type, updated_since=None):
+    if updated_since:
+        return f'aurehal_raw_{aurehal_type}_updated.jsonl.gz'
+    return f'aurehal_raw_{aurehal_type}.jsonl.gz'
+
+def get_temporary_file(name):
+    # a new empty file, unique to this process, so that jobs running on the same host never share their working files
+    fd, path = tempfile.mkstemp(dir='.', prefix=f'{name}.', suffix='.tmp')
+    os.close(fd)
+    return path
+
+def get_aurehal(aurehal_type, full_raw=False, updated_since=None):
+    # pages are retried one by one, from the last cursor that worked, and spilled to a local gzipped jsonl file
+    # as they arrive, so that the referential is never held whole in memory; returns the path of that file
+    # with updated_since, only the records updated since then are harvested
+    logger.debug(f'start {aurehal_type} aurehal' + (f' updated since {updated_since}' if updated_since else ''))
+    fl = get_fl(AUREHAL_FIELDS[aurehal_type], full_raw)
+    query = '*:*'
+    if updated_since:
+        query = quote_plus(f'{AUREHAL_UPDATE_DATE}:[{updated_since} TO *]')
+    spill_file = get_temporary_file(get_spill_name(aurehal_type, updated_since))
     nb_rows = 10000
     cursor='*'
-    data = []
-    while True:
-        url = f'https://api.archives-ouvertes.fr/ref/{aurehal_type}/?q=*:*&wt=json&fl=*&sort=docid asc&rows={nb_rows}&cursorMark={cursor}'
-        r = requests.get(url)
-        res = r.json()
-        new_cursor = quote_plus(res['nextCursorMark'])
-        data += res['response']['docs']
-        if new_cursor == cursor:
-            break
-        cursor = new_cursor
-    logger.debug(f'end {aurehal_type} aurehal')
-    return data
+    nb_docs = 0
+    try:
+        with gzip.open(spill_file, 'wt') as f:
+            while True:
+                docs, new_cursor = get_aurehal_page(aurehal_type, query, fl, nb_rows, cursor)
+                for doc in docs:
+                    f.write(json.dumps(doc) + '\n')
+                nb_docs += len(docs)
+                if new_cursor == cursor:
+                    break
+                cursor = new_cursor
+    except BaseException:
+        os.remove(spill_file)
+        raise
+    logger.debug(f'end {aurehal_type} aurehal, {nb_docs} records')
+    return spill_file
+
+def read_aurehal(spill_file):
+    with gzip.open(spill_file, 'rt') as f:
+        for line in f:
+            yield json.loads(line)
 
 def parse_aurehal(elt, aurehal_type, hal_idref):
     if aurehal_type == 'structure':
@@ -99,7 +152,7 @@ def parse_structure(elt):
         country = country_code_to_name.get(elt.get('country_s'))
         affiliation['detected_countries'] = [elt['country_s']]
 
-    for field in ['name_s', 'code_s', 'acronym_s', 'parentAcronym_s', 'parentName_s']:
+    for field in STRUCTURE_NAME_FIELDS:
         if isinstance(elt.get(field), str):
             affiliation_name += elt.get(field)+", "
         if isinstance(elt.get(field), list):
@@ -125,72 +178,266 @@ def parse_structure(elt):
         affiliation['ror'] = elt.get('ror_s')[0]
     return affiliation
 
-def create_docid_map(data, aurehal_type, hal_idref):
+class AurehalMap(object):
+    """Read-only docid -> parsed entity lookup, each entity being stored once whatever its number of aliases.
+
+    All the aliases of an entity return the same dict, which must be copied before being annotated.
+    """
+
+    def __init__(self, entities: list, docids: list):
+        self.entities = entities
+        self.index = {}
+        for row, row_docids in enumerate(docids):
+            for docid in row_docids:
+                self.index[docid] = row
+
+    def __contains__(self, docid) -> bool:
+        return docid in self.index
+
+    def __getitem__(self, docid) -> dict:
+        return self.entities[self.index[docid]]
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get(self, docid, default=None):
+        row = self.index.get(docid)
+        if row is None:
+            return default
+        return self.entities[row]
+
+
+class AurehalStore(object):
+    """Same lookups as AurehalMap, served from a memory-mapped SQLite file with an LRU of the hot docids.
+
+    Worker processes opening the same file share a single page-cache copy of it. Misses are cached as well, so that
+    the membership test and the lookup that follows it cost a single query.
+    """
+
+    def __init__(self, path: str, cache_size: int = AUREHAL_CACHE_SIZE, lock: int = None):
+        self.path = path
+        self.local = threading.local()
+        self.get_entity = lru_cache(maxsize=cache_size)(self.load_entity)
+        self.nb_docids = self.get_connection().execute('SELECT COUNT(*) FROM docids').fetchone()[0]
+        # the file descriptor of the shared lock that keeps the file from being evicted, released with the store
+        self.lock = lock
+
+    def get_connection(self) -> sqlite3.Connection:
+        # one read-only connection per thread and per process, since connections cannot cross a fork
+        if getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(f'file:{self.path}?mode=ro&immutable=1', uri=True)
+            connection.execute(f'PRAGMA mmap_size={AUREHAL_MMAP_SIZE}')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def load_entity(self, docid):
+        # the entity of a docid, None if it is unknown
+        res = self.get_connection().execute('SELECT entity FROM docids JOIN entities USING (row) WHERE docid = ?',
+                                            (str(docid),)).fetchone()
+        if res is None:
+            return None
+        return json.loads(res[0])
+
+    def __contains__(self, docid) -> bool:
+        return self.get_entity(docid) is not None
+
+    def __getitem__(self, docid) -> dict:
+        entity = self.get_entity(docid)
+        if entity is None:
+            raise KeyError(docid)
+        return entity
+
+    def __len__(self) -> int:
+        return self.nb_docids
+
+    def __del__(self):
+        if getattr(self, 'lock', None) is not None:
+            os.close(self.lock)
+
+    def get(self, docid, default=None):
+        entity = self.get_entity(docid)
+        if entity is None:
+            return default
+        return entity
+
+
+def build_aurehal_store(parsed_data, docids, path):
+    # path is a new file (empty files are empty databases for sqlite), never a store that may be in use
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE entities (row INTEGER PRIMARY KEY, entity TEXT NOT NULL)')
+    connection.execute('CREATE TABLE docids (docid TEXT PRIMARY KEY, row INTEGER NOT NULL) WITHOUT ROWID')
+    connection.executemany('INSERT INTO entities VALUES (?, ?)', ((row, json.dumps(elt)) for row, elt in enumerate(parsed_data)))
+    connection.executemany('INSERT OR REPLACE INTO docids VALUES (?, ?)',
+                           ((docid, row) for row, row_docids in enumerate(docids) for docid in row_docids))
+    connection.commit()
+    connection.execute('VACUUM')
+    connection.close()
+
+
+def get_row_docids(d):
     # for persons, ids look like "45004-175736" but the last part (person_id) are also unique, so we store both
-    docid_map = {}
+    row_docids = [str(d['docid'])]
+    if isinstance(d.get('aliasDocid_i'), list):
+        row_docids += [str(k) for k in d.get('aliasDocid_i')]
+    if isinstance(d.get('person_id'), str):
+        row_docids.append(d['person_id'])
+    return sorted(set(row_docids))
+
+def create_docid_map(data, aurehal_type, hal_idref):
+    # docids[row] lists all the ids under which parsed_data[row] is known
+    docids = []
     parsed_data = []
     for d in data:
-        docids = [d['docid']]
-        if isinstance(d.get('aliasDocid_i'), list):
-            docids += [str(k) for k in d.get('aliasDocid_i')]
-        if isinstance(d.get('person_id'), str):
-            docids.append(d['person_id'])
-        docids = list(set(docids))
         parsed_elt = parse_aurehal(d, aurehal_type, hal_idref)
         parsed_data.append(parsed_elt)
-        for docid in docids:
-            docid_map[str(docid)] = parsed_elt
-    logger.debug(f'{aurehal_type} : {len(data)} elts and {len(docid_map)} docids in map')
-    return parsed_data, docid_map
-
-def harvest_and_save_aurehal(collection_name, aurehal_type):
-    # raw data
-    data = get_aurehal(aurehal_type)
-    current_file = f'aurehal_raw_{aurehal_type}.json'
-    json.dump(data, open(current_file, 'w'))
-    os.system(f'gzip {current_file}')
-    upload_object('hal', f'{current_file}.gz', f'{collection_name}/{current_file}.gz')
-    os.system(f'rm -rf {current_file}.gz')
+        docids.append(get_row_docids(d))
+    nb_docids = len(set([docid for row_docids in docids for docid in row_docids]))
+    logger.debug(f'{aurehal_type} : {len(parsed_data)} elts and {nb_docids} docids in map')
+    return parsed_data, docids
+
+def patch_docid_map(parsed_data, docids, data, aurehal_type, hal_idref):
+    # applies the updated records to a previous map: a record replaces the row whose primary docid is its own or is added,
+    # and the docids it now holds (e.g. the aliases of the records merged into it) are taken from their previous rows,
+    # rows left without any docid being dropped. Records deleted without being merged cannot be seen this way.
+    parsed_data, docids = list(parsed_data), [list(row_docids) for row_docids in docids]
+    index = {docid: row for row, row_docids in enumerate(docids) for docid in row_docids}
+    nb_added, nb_updated = 0, 0
+    for d in data:
+        row_docids = get_row_docids(d)
+        parsed_elt = parse_aurehal(d, aurehal_type, hal_idref)
+        row = index.get(str(d['docid']))
+        if row is not None and parsed_data[row].get('hal_docid') != str(d['docid']):
+            # the docid is an alias of another entity, which is left as it is (but for that alias, moved below)
+            row = None
+        if row is None:
+            row = len(parsed_data)
+            parsed_data.append(parsed_elt)
+            docids.append(row_docids)
+            nb_added += 1
+        else:
+            for docid in docids[row]:
+                if docid not in row_docids:
+                    index.pop(docid)
+            parsed_data[row] = parsed_elt
+            nb_updated += 1
+        for docid in row_docids:
+            previous_row = index.get(docid)
+            if previous_row is not None and previous_row != row:
+                docids[previous_row].remove(docid)
+            index[docid] = row
+        docids[row] = row_docids
+    kept = [row for row, row_docids in enumerate(docids) if row_docids]
+    logger.debug(f'{aurehal_type} : {nb_added} elts added, {nb_updated} updated, {len(docids) - len(kept)} merged into others')
+    return [parsed_data[row] for row in kept], [docids[row] for row in kept]
+
+def get_hal_idref():
     hal_idref = {}
-    if aurehal_type == 'author':
-        try:
-            update_vip() 
-        except:
-            logger.debug('error in vip update!!!')
-        download_object('misc', 'vip.jsonl', f'vip.jsonl')
-        df_vip = pd.read_json('vip.jsonl', lines=True)
-        vips = df_vip.to_dict(orient='records')
-        for vip in vips:
-            orcid, id_hal_i, id_hal_s = None, None, None
-            idref = vip['id']
-            externalIds = vip.get('externalIds', [])
-            if isinstance(externalIds, list):
-                for ext in vip.get('externalIds', []):
-                    if 'id_hal_i' in ext['type']:
-                        id_hal_i = ext['id']
-                    if 'id_hal_s' in ext['type']:
-                        id_hal_s = ext['id']
-                    if 'orcid' in ext['type']:
-                        orcid = ext['id']
-                if id_hal_i:
-                    hal_idref[id_hal_i] = {'idref': idref.replace('idref', '')}
-                    if orcid:
-                        hal_idref[id_hal_i]['orcid'] = orcid
-                if id_hal_s:
-                    hal_idref[id_hal_s] = {'idref': idref.replace('idref', '')}
-                    if orcid:
-                        hal_idref[id_hal_s]['orcid'] = orcid
-    #parsed data
-    parsed_data, docid_map = create_docid_map(data, aurehal_type, hal_idref)
-    current_file = f'aurehal_{aurehal_type}.json'
-    json.dump(parsed_data, open(current_file, 'w'))
-    os.system(f'gzip {current_file}')
-    upload_object('hal', f'{current_file}.gz', f'{collection_name}/{current_file}.gz')
-    os.system(f'rm -rf {current_file}.gz')
-    
-    # doc id mapping
-    current_file = f'aurehal_{aurehal_type}_dict.json'
-    json.dump(docid_map, open(current_file, 'w'))
-    os.system(f'gzip {current_file}')
-    upload_object('hal', f'{current_file}.gz', f'{collection_name}/{current_file}.gz')
-    os.system(f'rm -rf {current_file}.gz')
+    try:
+        update_vip() 
+    except:
+        logger.debug('error in vip update!!!')
+    download_object('misc', 'vip.jsonl', f'vip.jsonl')
+    df_vip = pd.read_json('vip.jsonl', lines=True)
+    vips = df_vip.to_dict(orient='records')
+    for vip in vips:
+        orcid, id_hal_i, id_hal_s = None, None, None
+        idref = vip['id']
+        externalIds = vip.get('externalIds', [])
+        if isinstance(externalIds, list):
+            for ext in vip.get('externalIds', []):
+                if 'id_hal_i' in ext['type']:
+                    id_hal_i = ext['id']
+                if 'id_hal_s' in ext['type']:
+                    id_hal_s = ext['id']
+                if 'orcid' in ext['type']:
+                    orcid = ext['id']
+            if id_hal_i:
+                hal_idref[id_hal_i] = {'idref': idref.replace('idref', '')}
+                if orcid:
+                    hal_idref[id_hal_i]['orcid'] = orcid
+            if id_hal_s:
+                hal_idref[id_hal_s] = {'idref': idref.replace('idref', '')}
+                if orcid:
+                    hal_idref[id_hal_s]['orcid'] = orcid
+    return hal_idref
+
+def get_snapshot_id(parsed_data, docids):
+    # content address of a referential: the same map always gets the same id, whichever collection harvested it
+    digest = hashlib.sha256()
+    for piece in iter_json({'entities': parsed_data, 'docids': docids}, depth=2):
+        digest.update(piece.encode('utf-8'))
+    return digest.hexdigest()[0:16]
+
+def get_aurehal_state(collection_name, aurehal_type):
+    return get_json_object('hal', f'{collection_name}/aurehal_{aurehal_type}_state.json.gz', {})
+
+def get_aurehal_prefix(collection_name, aurehal_type, state=None):
+    # referentials are stored once per version in the shared snapshots, collections only point to one of them;
+    # collections harvested before the snapshots have their own copy
+    if state is None:
+        state = get_aurehal_state(collection_name, aurehal_type)
+    if state.get('snapshot_id'):
+        return f'{AUREHAL_SNAPSHOTS}/{aurehal_type}/{state["snapshot_id"]}'
+    return collection_name
+
+def link_aurehal(collection_name, aurehal_type, aurehal_from):
+    state = get_aurehal_state(aurehal_from, aurehal_type)
+    if not state.get('snapshot_id'):
+        logger.debug(f'no {aurehal_type} referential snapshot in {aurehal_from}, nothing to link')
+        return
+    upload_json('hal', state, f'{collection_name}/aurehal_{aurehal_type}_state.json.gz')
+
+def harvest_and_save_aurehal(collection_name, aurehal_type, full_raw=False, aurehal_from=None):
+    # with aurehal_from, only the records updated since the referential of that collection was harvested are fetched,
+    # and applied to its map
+    harvest_start = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    state, previous = {}, {}
+    if aurehal_from:
+        state = get_aurehal_state(aurehal_from, aurehal_type)
+        if state.get('last_update_date'):
+            previous = get_json_object('hal', f'{get_aurehal_prefix(aurehal_from, aurehal_type, state)}/aurehal_{aurehal_type}_map.json.gz', {})
+        if not previous:
+            logger.debug(f'no previous {aurehal_type} referential in {aurehal_from}, falling back to a full harvest')
+    updated_since = state.get('last_update_date') if previous else None
+    raw_file = get_aurehal(aurehal_type, full_raw, updated_since)
+    try:
+        hal_idref = {}
+        if aurehal_type == 'author':
+            hal_idref = get_hal_idref()
+        #parsed data
+        if previous:
+            parsed_data, docids = patch_docid_map(previous['entities'], previous['docids'], read_aurehal(raw_file), aurehal_type, hal_idref)
+        else:
+            parsed_data, docids = create_docid_map(read_aurehal(raw_file), aurehal_type, hal_idref)
+        snapshot_id = get_snapshot_id(parsed_data, docids)
+        prefix = f'{AUREHAL_SNAPSHOTS}/{aurehal_type}/{snapshot_id}'
+        # the sqlite store is uploaded last, a snapshot is complete once it is there
+        if get_etag('hal', f'{prefix}/aurehal_{aurehal_type}_map.sqlite'):
+            logger.debug(f'{aurehal_type} referential unchanged, reusing snapshot {snapshot_id}')
+        else:
+            logger.debug(f'publishing {aurehal_type} referential snapshot {snapshot_id}')
+            # raw data, uploaded as is from the local spill file
+            uploads = [submit_upload(upload_object, 'hal', raw_file, f'{prefix}/{get_spill_name(aurehal_type, updated_since)}')]
+            current_file = f'aurehal_{aurehal_type}.json'
+            uploads.append(submit_upload(upload_json, 'hal', parsed_data, f'{prefix}/{current_file}.gz'))
+
+            # doc id mapping, loaded back as an AurehalMap
+            current_file = f'aurehal_{aurehal_type}_map.json'
+            uploads.append(submit_upload(upload_json, 'hal', {'entities': parsed_data, 'docids': docids}, f'{prefix}/{current_file}.gz', depth=2))
+
+            # same mapping as a SQLite file, for workers using the on-disk store
+            current_file = f'aurehal_{aurehal_type}_map.sqlite'
+            store_file = get_temporary_file(current_file)
+            try:
+                build_aurehal_store(parsed_data, docids, store_file)
+                for upload in uploads:
+                    upload.result()
+                upload_object('hal', store_file, f'{prefix}/{current_file}')
+            finally:
+                os.remove(store_file)
+    finally:
+        os.remove(raw_file)
+    # the high-water mark is taken before harvesting, so that records updated during the harvest are seen again next time
+    upload_json('hal', {'last_update_date': harvest_start, 'patched_from': aurehal_from if previous else None, 'snapshot_id': snapshot_id},
+                f'{collection_name}/aurehal_{aurehal_type}_state.json.gz')
@@ -1,19 +1,40 @@
 import datetime
 from datetime import date
-import json
 import os
-import pymongo
+import queue
 import requests
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from retry import retry
 from urllib.parse import quote_plus
 
-from project.server.main.aurehal import harvest_and_save_aurehal
+from project.server.main.aurehal import harvest_and_save_aurehal, link_aurehal
+from project.server.main.fields import HAL_FIELDS, get_fl
 from project.server.main.logger import get_logger
-from project.server.main.parse import get_aurehal_from_OS, parse_hal
-from project.server.main.utils_swift import get_objects, get_paths_by_prefix, upload_object
+from project.server.main.mongo import drop_collection, insert_data
+from project.server.main.parquet import PARQUET_PARTITIONS, export_collection_to_parquet, upload_parquet
+from project.server.main.parse import get_aurehal_from_OS, parse_hal_chunk, start_parse_pool, stop_parse_pool
+from project.server.main.rate_limiter import hal_rate_limiter
+from project.server.main.utils_swift import STORAGE_ERRORS, delete_objects, get_json_object, get_paths_by_prefix, iter_objects, list_objects, submit_upload, \
+    upload_json
 
 logger = get_logger(__name__)
 
+HAL_HARVEST_WORKERS = int(os.getenv('HAL_HARVEST_WORKERS', 4))
+HAL_PREFETCH_PAGES = int(os.getenv('HAL_PREFETCH_PAGES', 10))
+HAL_WRITE_QUEUE_SIZE = int(os.getenv('HAL_WRITE_QUEUE_SIZE', 1))
+HAL_TARGET_WINDOW_SIZE = int(os.getenv('HAL_TARGET_WINDOW_SIZE', 100000))
+HAL_LOAD_WORKERS = int(os.getenv('HAL_LOAD_WORKERS', 4))
+HAL_LOAD_QUEUE_SIZE = int(os.getenv('HAL_LOAD_QUEUE_SIZE', 4))
+PIPELINE_END = object()
+PRODUCED_DATE = 'producedDate_tdate'
+MODIFIED_DATE = 'modifiedDate_tdate'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+HAL_CHUNK_FORMAT = os.getenv('HAL_CHUNK_FORMAT', 'json')
+CHUNK_FORMATS = ['json', 'jsonl']
+HAL_PARQUET_PARTITION = os.getenv('HAL_PARQUET_PARTITION')
+
 def nb_days_month(y, m):
     y2 = y
     m2 = m + 1
@@ -22,55 +43,75 @@ def nb_days_month(y, m):
         m2 = 1
     return (date(y2, m2, 1) - date(y, m, 1)).days
 
-def save_data(data, collection_name, year_start, year_end, chunk_index, aurehal):
-
+def get_year_start_end(year_start, year_end, date_field=PRODUCED_DATE):
+    # label of a date window, used both in logs and in file names
     year_start_end = 'all_years'
     if year_start and year_end:
         year_start_end = f'{year_start}_{year_end}'
+    if date_field == MODIFIED_DATE:
+        year_start_end = f'modified_{year_start_end}'
+    return year_start_end
+
+def get_harvest_state(collection_name):
+    return get_json_object('hal', f'{collection_name}/harvest_state.json.gz', {})
+
+def save_harvest_state(collection_name, state):
+    logger.debug(f'saving harvest state for {collection_name} : {state}')
+    upload_json('hal', state, f'{collection_name}/harvest_state.json.gz')
+
+def get_checkpoint(collection_name, year_start_end):
+    # one object per window, so that concurrent windows never overwrite each other's checkpoint
+    return get_json_object('hal', f'{collection_name}/checkpoints/{year_start_end}.json.gz', {})
+
+def save_checkpoint(collection_name, year_start_end, checkpoint):
+    upload_json('hal', checkpoint, f'{collection_name}/checkpoints/{year_start_end}.json.gz')
+
+def clear_checkpoints(collection_name):
+    paths = get_paths_by_prefix(container='hal', prefix=f'{collection_name}/checkpoints/')
+    logger.debug(f'removing {len(paths)} checkpoints of {collection_name}')
+    delete_objects('hal', paths)
+
+def clear_chunks(collection_name, before=None):
+    # chunk names depend on the window plan, so the chunks of a previous harvest are not all overwritten by a new one
+    # with before (a UTC date), only the chunks last written before it are removed
+    for prefix in ['raw', 'parsed', 'parquet']:
+        paths = [obj['name'] for obj in list_objects(container='hal', prefix=f'{collection_name}/{prefix}/')
+                 if before is None or obj.get('last_modified', '') < before.rstrip('Z')]
+        logger.debug(f'removing {len(paths)} {prefix} chunks of {collection_name}')
+        delete_objects('hal', paths)
+
+def save_data(data, collection_name, year_start, year_end, chunk_index, aurehal, date_field=PRODUCED_DATE, merge=False, chunk_format='json',
+              parquet_partition=None):
+    # chunk_index is numbered per window, and the window label is part of every file name
+    # so that windows harvested concurrently never write to the same local file
+    year_start_end = get_year_start_end(year_start, year_end, date_field)
     # 1. save raw data to OS
-    current_file = f'hal_{year_start_end}_{chunk_index}.json'
-    json.dump(data, open(current_file, 'w'))
-    os.system(f'gzip {current_file}')
-    upload_object('hal', f'{current_file}.gz', f'{collection_name}/raw/{current_file}.gz')
-    os.system(f'rm -rf {current_file}.gz')
+    # jsonl chunks can be streamed line by line, and their .gz files concatenated (e.g. with cat) into one readable chunk
+    lines = chunk_format == 'jsonl'
+    current_file = f'hal_{year_start_end}_{chunk_index}.{chunk_format}'
+    uploads = [submit_upload(upload_json, 'hal', data, f'{collection_name}/raw/{current_file}.gz', lines=lines)]
 
     # 2.transform data and save in object storage
-    current_file_parsed = f'hal_parsed_{year_start_end}_{chunk_index}.json'
-    data_parsed = [parse_hal(e, aurehal, collection_name) for e in data]
-    json.dump(data_parsed, open(current_file_parsed, 'w'))
-    os.system(f'gzip {current_file_parsed}')
-    upload_object('hal', f'{current_file_parsed}.gz', f'{collection_name}/parsed/{current_file_parsed}.gz')
-    os.system(f'rm -rf {current_file_parsed}.gz')
+    current_file_parsed = f'hal_parsed_{year_start_end}_{chunk_index}'
+    data_parsed = parse_hal_chunk(data, aurehal, collection_name)
+    uploads.append(submit_upload(upload_json, 'hal', data_parsed, f'{collection_name}/parsed/{current_file_parsed}.{chunk_format}.gz', lines=lines))
+    # columnar copy of the parsed chunk, for the aggregations that only need a few columns
+    if parquet_partition:
+        uploads += upload_parquet(collection_name, data_parsed, current_file_parsed, parquet_partition)
 
     #3. oa_details
     oa_details_data = []
     for d in data_parsed:
         elt = { 'hal_id': d['hal_id'], 'oa_details': d['oa_details'] }
         oa_details_data.append(elt)
-    current_file_oa_details = f'hal_oa_details_{year_start_end}_{chunk_index}.json'
-    json.dump(oa_details_data, open(current_file_oa_details, 'w'))
-    insert_data(collection_name, current_file_oa_details)
-    os.system(f'rm -rf {current_file_oa_details}.gz')
-
+    insert_data(collection_name, oa_details_data, merge)
 
-def harvest_and_insert(collection_name, harvest_aurehal=True, min_year=1000):
-    # 1. save aurehal structures
-    aurehal = {}
-    for ref in ['structure', 'author']:
-        if harvest_aurehal:
-            harvest_and_save_aurehal(collection_name, ref)
-        aurehal[ref] = get_aurehal_from_OS(collection_name, ref)
+    # the chunk is only done (and checkpointed) once its artifacts are stored, upload errors are raised here
+    for upload in uploads:
+        upload.result()
 
-    # 2. drop mongo 
-    logger.debug(f'dropping {collection_name} collection before insertion')
-    myclient = pymongo.MongoClient('mongodb://mongo:27017/')
-    myclient['hal'][collection_name].drop()
 
-    # 3. save publications
-    year_start = None
-    year_end = None
-    # year_start = 1900
-    # year_end = datetime.date.today().year
+def get_years_start_end(min_year=1000):
     year_prefix = '-01-01T00:00:00Z'
     year_suffix = '-12-31T23:59:59Z'
     years_start_end = [('1000'+year_prefix, '1990'+year_suffix),
@@ -85,19 +126,191 @@ def harvest_and_insert(collection_name, harvest_aurehal=True, min_year=1000):
             years_start_end.append((f'{y}-{str(m).zfill(2)}-01T00:00:00Z', f'{y}-{str(m).zfill(2)}-{D}T23:59:59Z'))
     years_start_end.append((str(datetime.datetime.now().year+1)+year_prefix, str(2100) + year_suffix))
     years_start_end = [y for y in years_start_end if y[0] >= str(min_year)]
+    return years_start_end
+
+def get_nb_docs(year_start, year_end, date_field=PRODUCED_DATE):
+    url = f'https://api.archives-ouvertes.fr/search/?q=*:*&wt=json&rows=0&fq={date_field}:[{year_start}%20TO%20{year_end}]'
+    return get_data_hal(url, 0)['response']['numFound']
+
+def split_window(year_start, year_end, nb_docs, target_window_size, date_field=PRODUCED_DATE):
+    # bisect the window until each part holds at most target_window_size docs (or cannot be split anymore)
+    start = datetime.datetime.strptime(year_start, DATE_FORMAT)
+    end = datetime.datetime.strptime(year_end, DATE_FORMAT)
+    if nb_docs <= target_window_size or (end - start).total_seconds() < 1:
+        return [(year_start, year_end, nb_docs)]
+    middle = start + datetime.timedelta(seconds=int((end - start).total_seconds() // 2))
+    left_end = middle.strftime(DATE_FORMAT)
+    right_start = (middle + datetime.timedelta(seconds=1)).strftime(DATE_FORMAT)
+    nb_left = get_nb_docs(year_start, left_end, date_field)
+    nb_right = get_nb_docs(right_start, year_end, date_field)
+    return split_window(year_start, left_end, nb_left, target_window_size, date_field) + \
+           split_window(right_start, year_end, nb_right, target_window_size, date_field)
+
+def merge_windows(windows, target_window_size):
+    # windows are contiguous and sorted, so neighbours can be merged while they stay under the target
+    merged = []
+    for (year_start, year_end, nb_docs) in windows:
+        if merged and merged[-1][2] + nb_docs <= target_window_size:
+            merged[-1] = (merged[-1][0], year_end, merged[-1][2] + nb_docs)
+        else:
+            merged.append((year_start, year_end, nb_docs))
+    return merged
+
+def plan_windows(years_start_end, target_window_size, nb_workers, date_field=PRODUCED_DATE):
+    def plan_one_window(year_start_end):
+        year_start, year_end = year_start_end
+        return split_window(year_start, year_end, get_nb_docs(year_start, year_end, date_field), target_window_size, date_field)
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        windows = [w for split_windows in executor.map(plan_one_window, years_start_end) for w in split_windows]
+    return merge_windows(windows, target_window_size)
+
+def get_harvest_plan(collection_name, years_start_end, target_window_size, nb_workers, date_field=PRODUCED_DATE, reuse_plan=False):
+    plan_path = f'{collection_name}/harvest_plan.json.gz'
+    start, end = years_start_end[0][0], years_start_end[-1][1]
+    if reuse_plan:
+        plan = get_json_object('hal', plan_path, {})
+        if plan.get('date_field') == date_field and plan.get('start') == start and plan.get('end') == end:
+            logger.debug(f"reusing harvest plan of {collection_name} with {len(plan['windows'])} windows")
+            return plan
+        logger.debug(f'no reusable harvest plan for {collection_name}, computing a new one')
+    windows = plan_windows(years_start_end, target_window_size, nb_workers, date_field)
+    plan = {'date_field': date_field, 'start': start, 'end': end, 'target_window_size': target_window_size,
+            'windows': [{'start': w[0], 'end': w[1], 'nb_docs': w[2]} for w in windows]}
+    for w in plan['windows']:
+        logger.debug(f"plan {get_year_start_end(w['start'], w['end'], date_field)} : {w['nb_docs']} docs")
+    logger.debug(f"harvest plan : {len(windows)} windows, {sum([w[2] for w in windows])} docs, target {target_window_size} docs per window")
+    upload_json('hal', plan, plan_path)
+    return plan
 
-    #years_start_end = [(1000, 1990),(1991,2000),(2001,2010)]
-    #for y in range(2011, datetime.datetime.now().year+1):
-    #    years_start_end.append((y, y))
-    #years_start_end.append((datetime.datetime.now().year+1,2100))
-    #years_start_end = [y for y in years_start_end if y[0] >= min_year]
-    logger.debug(f'years_start_end = {years_start_end}')
-    for (year_start, year_end) in years_start_end:
-        harvest_and_insert_one_year(collection_name, year_start, year_end, aurehal)
+def harvest_windows(collection_name, years_start_end, aurehal, fl, nb_workers, date_field=PRODUCED_DATE, resume=False, merge=False,
+                    chunk_format='json', parquet_partition=None):
+    logger.debug(f'harvesting {len(years_start_end)} windows on {date_field} with {nb_workers} workers')
+    # set when a window fails, so that the windows in flight stop at their next page instead of running to their end
+    cancel = threading.Event()
+    # windows are independent cursor streams, so they are harvested concurrently
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        futures = {executor.submit(harvest_and_insert_one_year, collection_name, year_start, year_end, aurehal, fl, date_field, resume, merge,
+                                   chunk_format, parquet_partition, cancel): (year_start, year_end)
+                   for (year_start, year_end) in years_start_end}
+        for future in as_completed(futures):
+            year_start_end = get_year_start_end(*futures[future], date_field)
+            try:
+                future.result()
+            except Exception:
+                logger.error(f'harvest failed for {year_start_end}, cancelling remaining windows')
+                cancel.set()
+                for f in futures:
+                    f.cancel()
+                raise
+            logger.debug(f'harvest done for {year_start_end}')
+
+def harvest_and_insert(collection_name, harvest_aurehal=True, min_year=1000, nb_workers=None, max_requests_per_second=None, full_raw=False,
+                       incremental=False, resume=False, target_window_size=None, reuse_plan=False, nb_parse_processes=None,
+                       aurehal_store=None, merge=False, chunk_format=None, parquet_partition=None, aurehal_from=None):
+    state = get_harvest_state(collection_name)
+    current_run = state.get('current_run')
+    if resume and current_run is None:
+        logger.debug(f'no interrupted harvest to resume for {collection_name}, starting a new one')
+        resume = False
+    if chunk_format is None:
+        chunk_format = HAL_CHUNK_FORMAT
+    if chunk_format not in CHUNK_FORMATS:
+        raise ValueError(f'unknown chunk format {chunk_format}, expected one of {CHUNK_FORMATS}')
+    if parquet_partition is None:
+        parquet_partition = HAL_PARQUET_PARTITION
+    if parquet_partition and parquet_partition not in PARQUET_PARTITIONS:
+        raise ValueError(f'unknown parquet partition {parquet_partition}, expected one of {PARQUET_PARTITIONS}')
+    if resume:
+        # the parameters of the interrupted run are reused so that windows and checkpoints match
+        logger.debug(f'resuming harvest of {collection_name} : {current_run}')
+        harvest_start, incremental, min_year, full_raw = current_run['harvest_start'], current_run['incremental'], current_run['min_year'], current_run['full_raw']
+        last_modified_date = current_run['last_modified_date']
+        chunk_format, parquet_partition = current_run.get('chunk_format', 'json'), current_run.get('parquet_partition')
+        # runs recorded before merge was part of them keep the merge of the task
+        merge = current_run.get('merge', merge)
+    else:
+        # the high-water mark is taken before harvesting, so that notices modified during the harvest are seen again next time
+        harvest_start = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        last_modified_date = state.get('last_modified_date')
+        if incremental and last_modified_date is None:
+            logger.debug(f'no previous harvest for {collection_name}, falling back to a full harvest')
+            incremental = False
+        if current_run:
+            state.pop('current_run')
+            save_harvest_state(collection_name, state)
+
+    # 1. save aurehal structures
+    aurehal = {}
+    for ref in ['structure', 'author']:
+        if harvest_aurehal and not resume:
+            harvest_and_save_aurehal(collection_name, ref, full_raw, aurehal_from)
+        elif aurehal_from and not resume:
+            # the collection uses the referential snapshot of aurehal_from as is
+            link_aurehal(collection_name, ref, aurehal_from)
+        aurehal[ref] = get_aurehal_from_OS(collection_name, ref, aurehal_store)
+
+    # 2. drop mongo 
+    # in merge mode the collection stays queryable and keeps the oa_details of previous observation dates
+    if not incremental and not resume and not merge:
+        drop_collection(collection_name)
+
+    if not resume:
+        clear_checkpoints(collection_name)
+        # a full harvest replaces the collection, and its leftover chunks would be reloaded along with the new ones
+        if not incremental and not merge:
+            clear_chunks(collection_name)
+        state['current_run'] = {'harvest_start': harvest_start, 'incremental': incremental, 'min_year': min_year,
+                                'full_raw': full_raw, 'last_modified_date': last_modified_date, 'chunk_format': chunk_format,
+                                'parquet_partition': parquet_partition, 'merge': merge}
+        save_harvest_state(collection_name, state)
+
+    # 3. save publications
+    if max_requests_per_second:
+        hal_rate_limiter.set_rate(max_requests_per_second)
+    # the rate limiter is shared by the jobs of the worker, the rate of this job is only in effect during it
+    try:
+        if nb_workers is None:
+            nb_workers = HAL_HARVEST_WORKERS
+        if target_window_size is None:
+            target_window_size = HAL_TARGET_WINDOW_SIZE
+        fl = get_fl(HAL_FIELDS, full_raw)
+        if incremental:
+            logger.debug(f'incremental harvest of {collection_name} for notices modified since {last_modified_date}')
+            date_field = MODIFIED_DATE
+            years_start_end = [(last_modified_date, harvest_start)]
+        else:
+            date_field = PRODUCED_DATE
+            years_start_end = get_years_start_end(min_year)
+        # a resumed harvest must walk the same windows as the interrupted one for its checkpoints to match
+        plan = get_harvest_plan(collection_name, years_start_end, target_window_size, nb_workers, date_field, reuse_plan or resume)
+        years_start_end = [(w['start'], w['end']) for w in plan['windows']]
+        logger.debug(f'years_start_end = {years_start_end}')
+        # parquet files written chunk by chunk only add rows, which is right when the dataset starts empty; an incremental
+        # or merged harvest brings new versions of publications already in it, and the dataset is rebuilt at the end
+        rebuild_parquet = parquet_partition and (incremental or merge)
+        start_parse_pool(aurehal, nb_parse_processes)
+        try:
+            harvest_windows(collection_name, years_start_end, aurehal, fl, nb_workers, date_field, resume, merge, chunk_format,
+                            None if rebuild_parquet else parquet_partition)
+        finally:
+            stop_parse_pool()
+    finally:
+        hal_rate_limiter.reset_rate()
+    if merge and not incremental:
+        # the chunks of a merged full harvest are all written after its start (resumed parts included), the older ones
+        # are left by previous plans and would be reloaded along with them
+        clear_chunks(collection_name, before=harvest_start)
+    if rebuild_parquet:
+        export_collection_to_parquet(collection_name, parquet_partition)
+
+    state.pop('current_run')
+    state['last_modified_date'] = harvest_start
+    save_harvest_state(collection_name, state)
 
 @retry(delay=300, tries=5, logger=logger)
 def get_data_hal(url, nb_rows_total):
     #logger.debug(f'{nb_rows_total} and new url {url}')
+    hal_rate_limiter.wait()
     r = requests.get(url, timeout=100)
     #logger.debug(f'status_code : {r.status_code}')
     try:
@@ -106,18 +319,17 @@ def get_data_hal(url, nb_rows_total):
         logger.debug(f'ERROR for url {url}')
         logger.debug(r.status_code)
         logger.debug(r.text)
+        hal_rate_limiter.wait()
         r = requests.get(url)
         res = r.json()
     return res
 
 @retry(delay=300, tries=5, logger=logger)
-def get_one_page(nb_rows,cursor,year_start,year_end, nb_rows_total):
-    year_start_end = 'all_years'
+def get_one_page(nb_rows,cursor,year_start,year_end, nb_rows_total, fl='*', date_field=PRODUCED_DATE):
+    year_start_end = get_year_start_end(year_start, year_end, date_field)
+    url = f'https://api.archives-ouvertes.fr/search/?q=*:*&wt=json&fl={fl}'
     if year_start and year_end:
-        year_start_end = f'{year_start}_{year_end}'
-    url = f'https://api.archives-ouvertes.fr/search/?q=*:*&wt=json&fl=*'
-    if year_start and year_end:
-        url += f'&fq=producedDate_tdate:[{year_start}%20TO%20{year_end}]'
+        url += f'&fq={date_field}:[{year_start}%20TO%20{year_end}]'
     url += f'&sort=docid asc&rows={nb_rows}&cursorMark={cursor}'
     res = get_data_hal(url, nb_rows_total)
     if cursor == '*':
@@ -125,78 +337,158 @@ def get_one_page(nb_rows,cursor,year_start,year_end, nb_rows_total):
     new_cursor = quote_plus(res['nextCursorMark'])
     return res, new_cursor
 
-def harvest_and_insert_one_year(collection_name, year_start, year_end, aurehal):
-    year_start_end = 'all_years'
-    if year_start and year_end:
-        year_start_end = f'{year_start}_{year_end}'
+def put_or_stop(q, item, stop):
+    # a blocking put that gives up once the pipeline has been stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
 
-    # todo save by chunk
-    nb_rows = 200
+def get_or_cancel(q, cancel, year_start_end):
+    # a blocking get that gives up once the whole harvest has been cancelled
+    while True:
+        if cancel is not None and cancel.is_set():
+            raise RuntimeError(f'harvest of {year_start_end} cancelled')
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            continue
+
+def prefetch_pages(nb_rows, cursor, year_start, year_end, fl, date_field, pages, stop):
+    # fetch stage: walks the cursor and pushes each page of docs, with the cursor that follows it, to the parse stage
     nb_rows_total = 0
-    cursor='*'
+    try:
+        while not stop.is_set():
+            res, new_cursor = get_one_page(nb_rows, cursor, year_start, year_end, nb_rows_total, fl, date_field)
+            if not put_or_stop(pages, (res['response']['docs'], new_cursor), stop):
+                return
+            if new_cursor == cursor:
+                break
+            cursor = new_cursor
+            nb_rows_total += nb_rows
+        put_or_stop(pages, PIPELINE_END, stop)
+    except Exception as e:
+        put_or_stop(pages, e, stop)
+
+def write_chunks(chunks, collection_name, year_start, year_end, aurehal, date_field, merge, chunk_format, parquet_partition, stop, errors):
+    # write stage: parse, compress, upload and insert each chunk in the background
+    year_start_end = get_year_start_end(year_start, year_end, date_field)
+    while True:
+        item = chunks.get()
+        if item is PIPELINE_END:
+            return
+        if errors or stop.is_set():
+            continue
+        data, chunk_index, next_cursor = item
+        try:
+            save_data(data, collection_name, year_start, year_end, chunk_index, aurehal, date_field, merge, chunk_format, parquet_partition)
+            # the chunk is durable, a resumed harvest can restart right after it
+            save_checkpoint(collection_name, year_start_end, {'cursor': next_cursor, 'chunk_index': chunk_index + 1, 'done': False})
+        except Exception as e:
+            logger.error(f'error while saving chunk {chunk_index} of {year_start_end}')
+            errors.append(e)
+
+def harvest_and_insert_one_year(collection_name, year_start, year_end, aurehal, fl='*', date_field=PRODUCED_DATE, resume=False, merge=False,
+                                chunk_format='json', parquet_partition=None, cancel=None):
+    year_start_end = get_year_start_end(year_start, year_end, date_field)
+
+    nb_rows = 200
     data = []
+    cursor = '*'
     chunk_index = 0
+    if resume:
+        checkpoint = get_checkpoint(collection_name, year_start_end)
+        if checkpoint.get('done'):
+            logger.debug(f'{year_start_end} already harvested, skipping')
+            return
+        cursor = checkpoint.get('cursor', cursor)
+        chunk_index = checkpoint.get('chunk_index', chunk_index)
+        if checkpoint:
+            logger.debug(f'resuming {year_start_end} at chunk {chunk_index}')
+    # notices selected by modification date, or re-harvested after a crash, may already be in the collection
+    merge = merge or resume or (date_field == MODIFIED_DATE)
     MAX_DATA_SIZE = 25000
-    while True:
-        res, new_cursor = get_one_page(nb_rows, cursor, year_start, year_end, nb_rows_total)
-        logger.debug(f'{year_start_end}|{len(data)}')
-        data += res['response']['docs']
-        if len(data) > MAX_DATA_SIZE:
-            save_data(data, collection_name, year_start, year_end, chunk_index, aurehal)
-            data = []
+    # the next cursor pages are fetched while previous chunks are being written
+    pages = queue.Queue(maxsize=HAL_PREFETCH_PAGES)
+    chunks = queue.Queue(maxsize=HAL_WRITE_QUEUE_SIZE)
+    stop = threading.Event()
+    errors = []
+    prefetcher = threading.Thread(target=prefetch_pages, args=(nb_rows, cursor, year_start, year_end, fl, date_field, pages, stop), daemon=True)
+    writer = threading.Thread(target=write_chunks, args=(chunks, collection_name, year_start, year_end, aurehal, date_field, merge, chunk_format, parquet_partition,
+                                                                   stop, errors), daemon=True)
+    prefetcher.start()
+    writer.start()
+    try:
+        while True:
+            page = get_or_cancel(pages, cancel, year_start_end)
+            if page is PIPELINE_END:
+                break
+            if isinstance(page, Exception):
+                raise page
+            docs, cursor = page
+            logger.debug(f'{year_start_end}|{len(data)}')
+            data += docs
+            if len(data) > MAX_DATA_SIZE:
+                if errors:
+                    raise errors[0]
+                chunks.put((data, chunk_index, cursor))
+                data = []
+                chunk_index += 1
+        if data:
+            chunks.put((data, chunk_index, cursor))
             chunk_index += 1
+    except Exception:
+        stop.set()
+        raise
+    finally:
+        chunks.put(PIPELINE_END)
+        writer.join()
+    if errors:
+        raise errors[0]
+    save_checkpoint(collection_name, year_start_end, {'cursor': cursor, 'chunk_index': chunk_index, 'done': True})
 
-        if new_cursor == cursor:
-            if data:
-                save_data(data, collection_name, year_start, year_end, chunk_index, aurehal)
-            break
-        cursor = new_cursor
-        nb_rows_total += nb_rows
 
+@retry(exceptions=STORAGE_ERRORS, delay=2, tries=50)
+def get_oa_details(path: str) -> list:
+    # publications are decoded one at a time, only their oa_details are kept
+    return [{'hal_id': publication.get('hal_id'), 'oa_details': publication.get('oa_details')}
+            for publication in iter_objects(container='hal', path=path)]
 
-def insert_data(collection_name, output_file):
-    myclient = pymongo.MongoClient('mongodb://mongo:27017/')
-    mydb = myclient['hal']
-    
-    ## mongo start
+def load_collection_from_object_storage(collection_name: str, merge: bool = False, nb_workers: int = None) -> None:
+    if nb_workers is None:
+        nb_workers = HAL_LOAD_WORKERS
+    # 1. Drop mongo collection, unless merging into it
+    if not merge:
+        drop_collection(collection_name)
     start = datetime.datetime.now()
-    mongoimport = f"mongoimport --numInsertionWorkers 2 --uri mongodb://mongo:27017/hal --file {output_file}" \
-                  f" --collection {collection_name} --jsonArray"
-    logger.debug(f'Mongoimport {output_file} start at {start}')
-    logger.debug(f'{mongoimport}')
-    os.system(mongoimport)
-    logger.debug(f'Checking indexes on collection {collection_name}')
-    mycol = mydb[collection_name]
-    mycol.create_index('hal_id')
-    end = datetime.datetime.now()
-    delta = end - start
-    logger.debug(f'Mongoimport done in {delta}')
-    ## mongo done
-
-
-def load_collection_from_object_storage(collection_name: str) -> None:
-    # 1. Drop mongo collection
-    logger.debug(f'dropping {collection_name} collection before insertion')
-    myclient = pymongo.MongoClient('mongodb://mongo:27017/')
-    myclient['hal'][collection_name].drop()
-    # 2. Collect all paths from Object Storage container with prefix
-    paths = get_paths_by_prefix(container='hal', prefix=f'{collection_name}/parsed/hal_parsed')
-    logger.debug(f'{len(paths)} paths retrieved in the container with prefix')
-    for path in paths:
-        # 3. For each path, collect all objects
-        publications = get_objects(container='hal', path=path)
-        # publications = [item for sublist in objects for item in sublist]
-        oa_details_data = []
-        # 4. Extract oa_details from publications
-        for publication in publications:
-            result = {
-                'hal_id': publication.get('hal_id'),
-                'oa_details': publication.get('oa_details')
-            }
-            oa_details_data.append(result)
-        # 5. Save it into mongo collection
-        current_file_oa_details = f'hal_oa_details.json'
-        json.dump(oa_details_data, open(current_file_oa_details, 'w'))
-        insert_data(collection_name=collection_name, output_file=current_file_oa_details)
-        os.system(f'rm -rf {current_file_oa_details}')
+    nb_chunks, nb_docs = 0, 0
+    # chunks downloaded and decoded ahead of the writer, bounded so that memory stays bounded too
+    pending = deque()
+
+    def write_oldest():
+        nonlocal nb_chunks, nb_docs
+        path, future = pending.popleft()
+        oa_details_data = future.result()
+        # chunks are written in listing order: chunks of incremental harvests come after the full ones
+        # and update notices already loaded
+        insert_data(collection_name, oa_details_data, merge or ('_modified_' in path))
+        nb_chunks += 1
+        nb_docs += len(oa_details_data)
+        delta = datetime.datetime.now() - start
+        logger.debug(f'{nb_chunks} chunks, {nb_docs} docs loaded in {collection_name} in {delta} '
+                     f'({round(nb_docs / max(delta.total_seconds(), 1e-6))} docs/sec)')
+
+    # 2. List the paths from Object Storage container with prefix, each chunk is downloaded as soon as it is listed
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        for obj in list_objects(container='hal', prefix=f'{collection_name}/parsed/hal_parsed'):
+            # 3. Download the chunks and extract oa_details in parallel
+            pending.append((obj['name'], executor.submit(get_oa_details, obj['name'])))
+            if len(pending) >= nb_workers + HAL_LOAD_QUEUE_SIZE:
+                # 4. Save them into mongo collection
+                write_oldest()
+        while pending:
+            write_oldest()
     return
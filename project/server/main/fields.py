@@ -0,0 +1,26 @@
+# Solr fields actually read by the parsers, requested explicitly with fl= instead of fl=*
+
+HAL_DATE_FIELDS = ['publicationDate_s', 'ePublicationDate_s', 'defenseDate_s', 'producedDate_s']
+HAL_ISSN_FIELDS = ['journalIssn_s', 'journalEissn_s']
+
+HAL_FIELDS = ['docid', 'halId_s', 'doiId_s', 'nntId_s', 'title_s', 'subTitle_s', 'abstract_s', 'structId_i',
+              'docType_s', 'proceedings_s', 'collCode_s', 'authIdHasStructure_fs', 'authFullName_s',
+              'authFirstName_s', 'authLastName_s', 'authQuality_s', 'authIdFormPerson_s', 'journalPublisher_s',
+              'journalTitle_s', 'keyword_s', 'en_domainAllCodeLabel_fs', 'funding_s', 'anrProjectReference_s',
+              'europeanProjectReference_s', 'irThesaurusId_s', 'swhidId_s', 'licence_s', 'submitType_s',
+              'openAccess_bool', 'fileMain_s', 'selfArchiving_bool', 'linkExtUrl_s'] + HAL_DATE_FIELDS + HAL_ISSN_FIELDS
+
+STRUCTURE_NAME_FIELDS = ['name_s', 'code_s', 'acronym_s', 'parentAcronym_s', 'parentName_s']
+
+AUREHAL_FIELDS = {
+    'structure': ['docid', 'aliasDocid_i', 'country_s', 'address_s', 'rnsr_s', 'ror_s'] + STRUCTURE_NAME_FIELDS,
+    'author': ['docid', 'aliasDocid_i', 'person_i', 'firstName_s', 'lastName_s', 'fullName_s', 'idHal_i', 'idHal_s',
+               'emailDomain_s', 'idrefId_s', 'orcidId_s']
+}
+
+
+def get_fl(fields: list, full_raw: bool = False) -> str:
+    # full_raw keeps every stored field, for when the raw archive must be complete
+    if full_raw:
+        return '*'
+    return ','.join(fields)
@@ -0,0 +1,43 @@
+from collections import deque
+
+
+class MultiPatternMatcher(object):
+    """Aho-Corasick automaton: finds every pattern occurring in a text in a single pass over it."""
+
+    def __init__(self, patterns: list):
+        self.patterns = list(patterns)
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+        for ix, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].add(ix)
+        # breadth-first, so that the failure state of a node is always built before its children
+        states = deque(self.goto[0].values())
+        while states:
+            state = states.popleft()
+            for char, next_state in self.goto[state].items():
+                states.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] |= self.output[self.fail[next_state]]
+
+    def find_all(self, text: str) -> set:
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state]:
+                found |= self.output[state]
+        return {self.patterns[ix] for ix in found}
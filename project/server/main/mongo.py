@@ -0,0 +1,79 @@
+import datetime
+import os
+import pymongo
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pymongo import UpdateOne
+
+from project.server.main.logger import get_logger
+
+logger = get_logger(__name__)
+
+MONGO_URL = os.getenv('MONGO_URL', 'mongodb://mongo:27017/')
+MONGO_BATCH_SIZE = int(os.getenv('MONGO_BATCH_SIZE', 1000))
+MONGO_INSERT_WORKERS = int(os.getenv('MONGO_INSERT_WORKERS', 2))
+client = None
+indexed_collections = set()
+index_lock = threading.Lock()
+
+
+def get_client() -> pymongo.MongoClient:
+    # one pooled client for the whole worker, shared by all harvesting threads
+    global client
+    if client is None:
+        client = pymongo.MongoClient(MONGO_URL)
+    return client
+
+
+def get_collection(collection_name: str):
+    return get_client()['hal'][collection_name]
+
+
+def drop_collection(collection_name: str) -> None:
+    logger.debug(f'dropping {collection_name} collection before insertion')
+    get_collection(collection_name).drop()
+    with index_lock:
+        indexed_collections.discard(collection_name)
+
+
+def ensure_index(collection_name: str) -> None:
+    # checked once per collection, not once per chunk
+    with index_lock:
+        if collection_name in indexed_collections:
+            return
+        logger.debug(f'Checking indexes on collection {collection_name}')
+        get_collection(collection_name).create_index('hal_id')
+        indexed_collections.add(collection_name)
+
+
+def get_merge_update(doc: dict) -> UpdateOne:
+    # only the observation dates of this doc are set, the ones already stored for the hal_id are kept
+    oa_details = doc.get('oa_details') or {}
+    fields = {f'oa_details.{observation_date}': v for observation_date, v in oa_details.items()}
+    return UpdateOne({'hal_id': doc['hal_id']}, {'$set': fields or {'hal_id': doc['hal_id']}}, upsert=True)
+
+
+def insert_batch(collection_name: str, batch: list, merge: bool = False) -> None:
+    mycol = get_collection(collection_name)
+    if merge:
+        mycol.bulk_write([get_merge_update(d) for d in batch], ordered=False)
+    else:
+        mycol.insert_many(batch, ordered=False)
+
+
+def insert_data(collection_name: str, data: list, merge: bool = False, batch_size: int = None, nb_workers: int = None) -> None:
+    if not data:
+        return
+    if batch_size is None:
+        batch_size = MONGO_BATCH_SIZE
+    if nb_workers is None:
+        nb_workers = MONGO_INSERT_WORKERS
+    start = datetime.datetime.now()
+    ensure_index(collection_name)
+    batches = [data[ix:ix + batch_size] for ix in range(0, len(data), batch_size)]
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        list(executor.map(partial(insert_batch, collection_name, merge=merge), batches))
+    delta = datetime.datetime.now() - start
+    rate = round(len(data) / max(delta.total_seconds(), 1e-6))
+    logger.debug(f'{len(data)} docs {"merged" if merge else "inserted"} in {collection_name} in {delta} ({rate} docs/sec)')
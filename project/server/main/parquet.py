@@ -0,0 +1,138 @@
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from io import BytesIO
+from retry import retry
+
+from project.server.main.logger import get_logger
+from project.server.main.utils_swift import STORAGE_ERRORS, delete_objects, get_paths_by_prefix, iter_objects, list_objects, submit_upload, \
+    upload_content
+
+logger = get_logger(__name__)
+
+PARQUET_COMPRESSION = os.getenv('PARQUET_COMPRESSION', 'zstd')
+PARQUET_PARTITIONS = ['year', 'observation_date']
+
+AFFILIATION_TYPE = pa.struct([
+    ('hal_docid', pa.string()),
+    ('name', pa.string()),
+    ('country', pa.string()),
+    ('detected_countries', pa.list_(pa.string())),
+    ('rnsr', pa.string()),
+    ('ror', pa.string()),
+])
+AUTHOR_TYPE = pa.struct([
+    ('hal_docid', pa.string()),
+    ('person_id', pa.string()),
+    ('full_name', pa.string()),
+    ('first_name', pa.string()),
+    ('last_name', pa.string()),
+    ('id_hal_s', pa.string()),
+    ('idref', pa.string()),
+    ('orcid', pa.string()),
+    ('author_position', pa.int32()),
+    ('role', pa.string()),
+    ('corresponding', pa.bool_()),
+    # hal_docid of the affiliations of the author, the structures themselves are in the affiliations column
+    ('affiliations', pa.list_(pa.string())),
+])
+# one row per publication and observation date, hot fields flat, authors and affiliations nested
+PUBLICATION_SCHEMA = pa.schema([
+    ('hal_id', pa.string()),
+    ('doi', pa.string()),
+    ('year', pa.string()),
+    ('published_date', pa.string()),
+    ('genre', pa.string()),
+    ('hal_docType', pa.string()),
+    ('journal_name', pa.string()),
+    ('publisher', pa.string()),
+    ('has_grant', pa.bool_()),
+    ('detected_countries', pa.list_(pa.string())),
+    ('observation_date', pa.string()),
+    ('snapshot_date', pa.string()),
+    ('is_oa', pa.bool_()),
+    ('oa_host_type', pa.string()),
+    ('oa_colors', pa.list_(pa.string())),
+    ('repositories', pa.list_(pa.string())),
+    ('authors', pa.list_(AUTHOR_TYPE)),
+    ('affiliations', pa.list_(AFFILIATION_TYPE)),
+])
+
+
+def pick(elt: dict, struct_type: pa.StructType) -> dict:
+    # parsed entities carry more fields than the schema, and must not be modified as they are shared
+    return {field.name: elt.get(field.name) for field in struct_type}
+
+
+def get_rows(publication: dict) -> list:
+    base = {field: publication.get(field) for field in PUBLICATION_SCHEMA.names}
+    authors = []
+    for author in publication.get('authors') or []:
+        row = pick(author, AUTHOR_TYPE)
+        row['affiliations'] = [a.get('hal_docid') for a in author.get('affiliations') or []]
+        authors.append(row)
+    base['authors'] = authors
+    base['affiliations'] = [pick(a, AFFILIATION_TYPE) for a in publication.get('affiliations') or []]
+    rows = []
+    for observation_date, oa_details in (publication.get('oa_details') or {}).items():
+        row = dict(base)
+        for field in ['snapshot_date', 'is_oa', 'oa_host_type', 'oa_colors', 'repositories']:
+            row[field] = oa_details.get(field)
+        row['observation_date'] = observation_date
+        rows.append(row)
+    return rows
+
+
+def get_partitions(publications, partition_by: str = 'year') -> dict:
+    # rows grouped by the value of the partition column
+    if partition_by not in PARQUET_PARTITIONS:
+        raise ValueError(f'unknown parquet partition {partition_by}, expected one of {PARQUET_PARTITIONS}')
+    partitions = {}
+    for publication in publications:
+        for row in get_rows(publication):
+            partitions.setdefault(row[partition_by] or 'unknown', []).append(row)
+    return partitions
+
+
+def to_parquet(rows: list, partition_by: str = None) -> bytes:
+    # as in hive-style datasets, the partition column is only in the path of the files, not in the files
+    schema = PUBLICATION_SCHEMA
+    if partition_by:
+        schema = schema.remove(schema.get_field_index(partition_by))
+    table = pa.Table.from_pylist(rows, schema=schema)
+    buffer = BytesIO()
+    pq.write_table(table, buffer, compression=PARQUET_COMPRESSION)
+    return buffer.getvalue()
+
+
+def upload_parquet(collection_name: str, publications, file_name: str, partition_by: str = 'year') -> list:
+    # hive-style layout, {collection}/parquet/{partition_by}={value}/{file_name}.parquet, readable as one dataset
+    uploads = []
+    for value, rows in get_partitions(publications, partition_by).items():
+        target = f'{collection_name}/parquet/{partition_by}={value}/{file_name}.parquet'
+        uploads.append(submit_upload(upload_content, 'hal', to_parquet(rows, partition_by), target))
+    return uploads
+
+
+@retry(exceptions=STORAGE_ERRORS, delay=2, tries=50)
+def export_chunk(collection_name: str, path: str, partition_by: str = 'year', exported: set = None) -> set:
+    # publications already in exported are skipped, the hal_id of the exported ones are returned
+    file_name = path.split('/')[-1].split('.')[0]
+    publications = [p for p in iter_objects('hal', path) if exported is None or p.get('hal_id') not in exported]
+    for upload in upload_parquet(collection_name, publications, file_name, partition_by):
+        upload.result()
+    return {p.get('hal_id') for p in publications}
+
+
+def export_collection_to_parquet(collection_name: str, partition_by: str = 'year') -> None:
+    # builds the parquet dataset of a collection from the parsed chunks already in the object storage
+    # a publication harvested again (by an incremental harvest, or by a merge with another window plan) is in several
+    # chunks: the dataset is rebuilt from scratch, the most recent chunks first, and each publication is only kept once
+    delete_objects('hal', get_paths_by_prefix(container='hal', prefix=f'{collection_name}/parquet/'))
+    chunks = sorted(list_objects(container='hal', prefix=f'{collection_name}/parsed/hal_parsed'),
+                    key=lambda obj: (obj.get('last_modified', ''), obj['name']), reverse=True)
+    exported = set()
+    for nb_chunks, obj in enumerate(chunks, 1):
+        exported |= export_chunk(collection_name, obj['name'], partition_by, exported)
+        logger.debug(f'{nb_chunks} chunks of {collection_name} exported to parquet')
@@ -1,12 +1,23 @@
+import calendar
+import datetime
+import fcntl
+import gc
+import gzip
 import os
 import json
+import multiprocessing
 import re
+import shutil
 from dateutil import parser
+from functools import lru_cache, partial
 from tokenizers import normalizers
 from tokenizers.normalizers import NFD, StripAccents, Lowercase, BertNormalizer, Sequence, Strip
 from tokenizers import pre_tokenizers
 from tokenizers.pre_tokenizers import Whitespace
-from project.server.main.utils_swift import upload_object, download_object
+from project.server.main.aurehal import AurehalMap, AurehalStore, get_aurehal_prefix
+from project.server.main.fields import HAL_DATE_FIELDS, HAL_ISSN_FIELDS
+from project.server.main.matcher import MultiPatternMatcher
+from project.server.main.utils_swift import get_cached_file, get_json_object, upload_object
 from project.server.main.logger import get_logger
 
 normalizer = Sequence([BertNormalizer(clean_text=True,
@@ -17,41 +28,97 @@ pre_tokenizer = pre_tokenizers.Sequence([Whitespace()])
 
 logger = get_logger(__name__)
 
+AUREHAL_STORE = os.getenv('AUREHAL_STORE', 'memory')
+AUREHAL_CACHE_DIR = os.getenv('AUREHAL_CACHE_DIR', 'aurehal_cache')
+AUREHAL_CACHE_SNAPSHOTS = int(os.getenv('AUREHAL_CACHE_SNAPSHOTS', 2))
+NORMALIZE_CACHE_SIZE = int(os.getenv('NORMALIZE_CACHE_SIZE', 500000))
+REPOSITORY_CACHE_SIZE = int(os.getenv('REPOSITORY_CACHE_SIZE', 100000))
+DATE_CACHE_SIZE = int(os.getenv('DATE_CACHE_SIZE', 100000))
+DATE_PATTERN = re.compile(r'^(\d{4})(?:-(\d{2})(?:-(\d{2}))?)?$')
+REPOSITORIES_FILE = os.getenv('REPOSITORIES_FILE', os.path.join(os.path.dirname(__file__), 'repositories.json'))
+HAL_PARSE_PROCESSES = int(os.getenv('HAL_PARSE_PROCESSES', 0))
+PARSE_CHUNKSIZE = 500
+parse_pool = None
+shared_aurehal = None
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
 def normalize(x, min_length = 0):
     normalized = normalizer.normalize_str(x)
     normalized = normalized.replace('\n', ' ')
     normalized = re.sub(' +', ' ', normalized)
     return " ".join([e[0] for e in pre_tokenizer.pre_tokenize_str(normalized) if len(e[0]) > min_length])
 
+def normalize_batch(texts, min_length = 0):
+    # a whole chunk in one call, each distinct string being normalized (or looked up in the cache) only once
+    normalized = {}
+    for x in texts:
+        if x not in normalized:
+            normalized[x] = normalize(x, min_length)
+    return [normalized[x] for x in texts]
+
+def get_normalize_stats():
+    info = normalize.cache_info()
+    nb_calls = info.hits + info.misses
+    return {'hits': info.hits, 'misses': info.misses, 'hit_rate': round(info.hits / nb_calls, 4) if nb_calls else 0,
+            'size': info.currsize, 'max_size': info.maxsize}
+
+def get_repository_rules(rules_file=REPOSITORIES_FILE):
+    # rules are tried in order: a prefix of the url (without www.), or substrings that must all be in the url
+    rules = json.load(open(rules_file, 'r'))
+    matcher = MultiPatternMatcher(sorted(set([p for rule in rules for p in rule.get('patterns', [])])))
+    rules_by_pattern = {}
+    # prefixes are grouped by length, so that a url is only looked up once per length instead of once per rule
+    rules_by_prefix = {}
+    for priority, rule in enumerate(rules):
+        for p in rule.get('patterns', []):
+            rules_by_pattern.setdefault(p, []).append(priority)
+        if rule.get('prefix'):
+            rules_by_prefix.setdefault(len(rule['prefix']), {}).setdefault(rule['prefix'], []).append(priority)
+    return rules, matcher, rules_by_pattern, rules_by_prefix
+
+repository_rules, repository_matcher, repository_rules_by_pattern, repository_rules_by_prefix = get_repository_rules()
+
+@lru_cache(maxsize=REPOSITORY_CACHE_SIZE)
 def get_repository(a_repo: str) -> str:
-    if a_repo.replace('www.', '')[0:3].lower() == 'hal':
-        return 'HAL'
-    for r in ['bioRxiv', 'medRxiv', 'arXiv', 'Research Square', 'Zenodo', 'Archimer', 'RePEc', 'CiteSeerX', 'univOAK']:
-        if r.lower().replace(' ', '') in a_repo.lower():
-            return r
-    if 'lilloa' in a_repo.lower():
-        return 'LillOA (Lille Open Archive)'
-    if 'ucl.ac.uk' in a_repo.lower():
-        return 'UCL Discovery'
-    if 'lirias' in a_repo.lower() and 'kuleuven' in a_repo.lower():
-        return 'LIRIAS (KU Leuven)'
-    if 'pure.atira.dk' in a_repo.lower():
-        return 'Pure (Denmark)'
-    if 'digital.csic.es' in a_repo.lower():
-        return 'DIGITAL.CSIC (Spain)'
-    if 'escholarship.org/ark' in a_repo.lower():
-        return 'California Digital Library - eScholarship'
-    if 'jupiter.its.unimelb.edu.au' in a_repo.lower():
-        return 'University of Melbourne - Minerva Access'
-    if 'helda.helsinki' in a_repo.lower():
-        return 'HELDA - Digital Repository of the University of Helsinki'
-    if 'osti.gov' in a_repo.lower():
-        return 'US Office of Scientific and Technical Information'
-    for f in ['pubmedcentral', 'ncbi.nlm.nih.gov/pmc', 'europepmc']:
-        if f in a_repo:
-            return 'PubMed Central'
+    candidates = set()
+    without_www = a_repo.replace('www.', '')
+    for length, rules_by_prefix in repository_rules_by_prefix.items():
+        candidates.update(rules_by_prefix.get(without_www[0:length].lower(), []))
+    for p in repository_matcher.find_all(a_repo.lower()):
+        candidates.update(repository_rules_by_pattern[p])
+    for priority in sorted(candidates):
+        rule = repository_rules[priority]
+        patterns = rule.get('patterns', [])
+        if rule.get('case_sensitive'):
+            if all([p in a_repo for p in patterns]):
+                return rule['name']
+        elif all([p in a_repo.lower() for p in patterns]):
+            return rule['name']
     return a_repo
 
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date_cached(x: str, today: datetime.date) -> str:
+    # fast path for YYYY, YYYY-MM and YYYY-MM-DD, giving the same result as dateutil,
+    # which completes a partial date with today's month and day (the day being capped to the end of the month)
+    m = DATE_PATTERN.match(x)
+    if m and m.group(1) >= '1000':
+        try:
+            year = int(m.group(1))
+            month = int(m.group(2)) if m.group(2) else today.month
+            if m.group(3):
+                day = int(m.group(3))
+            else:
+                day = min(today.day, calendar.monthrange(year, month)[1])
+            return datetime.datetime(year, month, day).isoformat()
+        except ValueError:
+            pass
+    # dateutil is given the today of the cache key, and not the clock, so that the cached result only depends on the key
+    return parser.parse(x, default=datetime.datetime.combine(today, datetime.time())).isoformat()
+
+def parse_date(x: str) -> str:
+    # today is part of the cache key, as it is part of the result for partial dates
+    return parse_date_cached(x, datetime.date.today())
+
 def get_millesime(x: str) -> str:
     try:
         if x[0:4] < '2021':
@@ -69,15 +136,140 @@ def get_millesime(x: str) -> str:
     except:
         return x
 
-def get_aurehal_from_OS(collection_name, aurehal_type):
-    target_file = f'aurehal_{collection_name}_{aurehal_type}_dict.json'
-    os.system(f'rm -rf {target_file}.gz')
-    os.system(f'rm -rf {target_file}')
-    download_object('hal', f'{collection_name}/aurehal_{aurehal_type}_dict.json.gz', f'{target_file}.gz')
-    os.system(f'gunzip {target_file}.gz')
-    return json.load(open(target_file, 'r'))
+def lock_aurehal_snapshot(snapshot_dir):
+    # every user of a local snapshot holds a shared lock on its directory (a file descriptor, inherited by the forked
+    # parse workers), and eviction only removes the snapshots it can lock exclusively
+    while True:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        lock = os.open(snapshot_dir, os.O_RDONLY)
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        try:
+            # the snapshot may have been evicted while waiting for the lock
+            if os.path.samestat(os.fstat(lock), os.stat(snapshot_dir)):
+                return lock
+        except FileNotFoundError:
+            pass
+        os.close(lock)
+
+def evict_aurehal_snapshots(snapshot_dir, keep=None):
+    # each refresh of a referential publishes a new snapshot: only the most recently used ones are kept on disk,
+    # the one in use (just touched) always being among them, and the ones still used by other jobs are left as well
+    if keep is None:
+        keep = AUREHAL_CACHE_SNAPSHOTS
+    os.utime(snapshot_dir)
+    type_dir = os.path.dirname(snapshot_dir)
+    snapshot_dirs = sorted([os.path.join(type_dir, d) for d in os.listdir(type_dir)], key=os.path.getmtime, reverse=True)
+    for old_dir in snapshot_dirs[max(keep, 1):]:
+        try:
+            lock = os.open(old_dir, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.debug(f'aurehal snapshot {old_dir} still in use, kept in the local cache')
+            os.close(lock)
+            continue
+        logger.debug(f'removing aurehal snapshot {old_dir} from the local cache')
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.close(lock)
+
+def get_aurehal_snapshot(prefix, aurehal_type, store):
+    # snapshots never change once published, a worker keeps its local copy as long as the etag matches
+    snapshot_dir = os.path.join(AUREHAL_CACHE_DIR, prefix)
+    lock = lock_aurehal_snapshot(snapshot_dir)
+    try:
+        evict_aurehal_snapshots(snapshot_dir)
+        if store == 'sqlite':
+            target_file = get_cached_file('hal', f'{prefix}/aurehal_{aurehal_type}_map.sqlite', os.path.join(snapshot_dir, f'aurehal_{aurehal_type}_map.sqlite'))
+            if target_file:
+                # the store opens its connections lazily, in every thread, and keeps the lock as long as it is used
+                return AurehalStore(target_file, lock=lock)
+            logger.debug(f'no aurehal sqlite store in {prefix}, loading it in memory')
+        target_file = get_cached_file('hal', f'{prefix}/aurehal_{aurehal_type}_map.json.gz', os.path.join(snapshot_dir, f'aurehal_{aurehal_type}_map.json.gz'))
+        with gzip.open(target_file, 'rt') as f:
+            aurehal_map = json.load(f)
+    except BaseException:
+        os.close(lock)
+        raise
+    # the map is in memory, the snapshot can be evicted
+    os.close(lock)
+    return AurehalMap(aurehal_map['entities'], aurehal_map['docids'])
+
+def get_aurehal_from_OS(collection_name, aurehal_type, store=None):
+    if store is None:
+        store = AUREHAL_STORE
+    prefix = get_aurehal_prefix(collection_name, aurehal_type)
+    if prefix != collection_name:
+        return get_aurehal_snapshot(prefix, aurehal_type, store)
+    if store == 'sqlite':
+        # downloaded through a temporary file unique to the process and then moved, so that workers already reading
+        # the file keep their copy and concurrent downloads never clobber each other
+        target_file = get_cached_file('hal', f'{collection_name}/aurehal_{aurehal_type}_map.sqlite', f'aurehal_{collection_name}_{aurehal_type}_map.sqlite')
+        if target_file:
+            return AurehalStore(target_file)
+        logger.debug(f'no aurehal sqlite store for {collection_name} {aurehal_type}, loading it in memory')
+    # the JSON maps are decoded straight from the object storage, no local file is shared with the other workers
+    aurehal_map = get_json_object('hal', f'{collection_name}/aurehal_{aurehal_type}_map.json.gz')
+    if aurehal_map is not None:
+        return AurehalMap(aurehal_map['entities'], aurehal_map['docids'])
+    # collections harvested before the map format only have the (duplicated) docid dict
+    logger.debug(f'no aurehal map for {collection_name} {aurehal_type}, loading the docid dict')
+    return get_json_object('hal', f'{collection_name}/aurehal_{aurehal_type}_dict.json.gz')
+
+def start_parse_pool(aurehal, nb_processes=None):
+    # workers are forked once the referentials are loaded, so they share them copy-on-write
+    # instead of receiving a pickled copy with every task
+    global parse_pool, shared_aurehal
+    if nb_processes is None:
+        nb_processes = HAL_PARSE_PROCESSES
+    if not nb_processes:
+        return None
+    shared_aurehal = aurehal
+    # keeps the garbage collector of the workers from touching (hence copying) the shared pages
+    gc.freeze()
+    parse_pool = multiprocessing.get_context('fork').Pool(nb_processes)
+    logger.debug(f'parse pool started with {nb_processes} processes')
+    return parse_pool
+
+def stop_parse_pool():
+    global parse_pool, shared_aurehal
+    if parse_pool is not None:
+        parse_pool.close()
+        parse_pool.join()
+        parse_pool = None
+        gc.unfreeze()
+    shared_aurehal = None
+
+def parse_hal_shared(notice, snapshot_date):
+    return parse_hal(notice, shared_aurehal, snapshot_date)
 
-def parse_hal(notice, aurehal, snapshot_date):
+def parse_hal_chunk(data, aurehal, snapshot_date):
+    if parse_pool is None:
+        data_parsed = [parse_hal(e, aurehal, snapshot_date, with_title_first_author=False) for e in data]
+        set_title_first_author(data_parsed)
+        logger.debug(f'normalize cache : {get_normalize_stats()}')
+        return data_parsed
+    return parse_pool.map(partial(parse_hal_shared, snapshot_date=snapshot_date), data, chunksize=PARSE_CHUNKSIZE)
+
+def get_first_author_name(res):
+    if isinstance(res.get('authors'), list) and len(res['authors']) > 0:
+        return res['authors'][0].get('full_name')
+    return None
+
+def set_title_first_author(data_parsed):
+    titles = iter(normalize_batch([res['title'] for res in data_parsed if res.get('title')], 1))
+    names = iter(normalize_batch([get_first_author_name(res) for res in data_parsed if get_first_author_name(res)], 1))
+    for res in data_parsed:
+        title_first_author = ""
+        if res.get('title'):
+            title_first_author += next(titles).strip()
+        if get_first_author_name(res):
+            title_first_author += ';'+next(names)
+        if title_first_author:
+            res['title_first_author'] = title_first_author
+
+def parse_hal(notice, aurehal, snapshot_date, with_title_first_author=True):
     res = {}
     res['sources'] = ['HAL']
     if isinstance(notice.get('doiId_s'), str):
@@ -110,11 +302,14 @@ def parse_hal(notice, aurehal, snapshot_date):
     if isinstance(notice.get('structId_i'), list):
         res['hal_struct_id'] = notice['structId_i']
         affiliations = []
+        # referential entities are shared by all the notices (and threads), only copies of them are annotated
+        structures = []
         for s in notice.get('structId_i'):
             structId = str(s)
             if structId in aurehal.get('structure', {}):
-                if aurehal['structure'][structId] not in affiliations:
-                    current_structure = aurehal['structure'][structId]
+                if aurehal['structure'][structId] not in structures:
+                    structures.append(aurehal['structure'][structId])
+                    current_structure = dict(aurehal['structure'][structId])
                     current_structure['structId'] = structId
                     affiliations.append(current_structure)
             else:
@@ -196,9 +391,9 @@ def parse_hal(notice, aurehal, snapshot_date):
             personIdStr = authorIdStr.split('-')[1] #person_id aka idHAL_i even idHAL not always in the aurehal data??
             author = {}
             if personIdStr in aurehal.get('author', {}):
-                author = aurehal['author'][personIdStr]
+                author = dict(aurehal['author'][personIdStr])
             elif authorIdStr in aurehal.get('author', {}):
-                author = aurehal['author'][authorIdStr]
+                author = dict(aurehal['author'][authorIdStr])
             else:
                 logger.debug(f'author ;{authorIdStr}; not in aurehal ?; type: {type(authorIdStr)}')
                 if isinstance(authorIdStr, str):
@@ -226,10 +421,10 @@ def parse_hal(notice, aurehal, snapshot_date):
 
     # DATE
     publication_date = None
-    for f in ['publicationDate_s', 'ePublicationDate_s', 'defenseDate_s', 'producedDate_s']:
+    for f in HAL_DATE_FIELDS:
         if isinstance(notice.get(f), str) and publication_date is None:
             try:
-                publication_date = parser.parse(notice[f]).isoformat()
+                publication_date = parse_date(notice[f])
                 res['published_date'] = publication_date
                 res['year'] = publication_date[0:4]
                 break
@@ -247,7 +442,7 @@ def parse_hal(notice, aurehal, snapshot_date):
    
     # ISSN
     journal_issns = []
-    for f in ['journalIssn_s', 'journalEissn_s']:
+    for f in HAL_ISSN_FIELDS:
         if isinstance(notice.get(f), str):
             journal_issns.append(notice.get(f).strip())
     if journal_issns:
@@ -368,12 +563,7 @@ def parse_hal(notice, aurehal, snapshot_date):
 
 
     ## title - first author
-    title_first_author = ""
-    if res.get('title'):
-        title_first_author += normalize(res.get('title'), 1).strip()
-    if isinstance(res.get('authors'), list) and len(res['authors']) > 0:
-        if res['authors'][0].get('full_name'):
-            title_first_author += ';'+normalize(res['authors'][0].get('full_name'), 1)
-    if title_first_author:
-        res['title_first_author'] = title_first_author
+    # parse_hal_chunk computes it afterwards for the whole chunk at once
+    if with_title_first_author:
+        set_title_first_author([res])
     return res
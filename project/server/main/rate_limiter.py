@@ -0,0 +1,41 @@
+import os
+import threading
+import time
+
+from project.server.main.logger import get_logger
+
+logger = get_logger(__name__)
+
+HAL_MAX_REQUESTS_PER_SECOND = float(os.getenv('HAL_MAX_REQUESTS_PER_SECOND', 4))
+
+
+class RateLimiter(object):
+    """Spread calls evenly so that all threads together stay under max_per_second."""
+
+    def __init__(self, max_per_second: float):
+        self.lock = threading.Lock()
+        self.next_call = 0.0
+        self.default_rate = max_per_second
+        self.set_rate(max_per_second)
+
+    def set_rate(self, max_per_second: float) -> None:
+        with self.lock:
+            self.max_per_second = max_per_second
+            self.interval = 1.0 / max_per_second if max_per_second and max_per_second > 0 else 0.0
+        logger.debug(f'rate limit set to {max_per_second} requests per second')
+
+    def reset_rate(self) -> None:
+        # the limiter outlives the jobs of a worker, a job setting its own rate restores the default when done
+        self.set_rate(self.default_rate)
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+# shared by every thread calling api.archives-ouvertes.fr
+hal_rate_limiter = RateLimiter(HAL_MAX_REQUESTS_PER_SECOND)
@@ -3,6 +3,7 @@ import datetime
 import os
 import requests
 from project.server.main.feed import harvest_and_insert, load_collection_from_object_storage
+from project.server.main.parquet import export_collection_to_parquet
 
 from project.server.main.logger import get_logger
 
@@ -12,12 +13,33 @@ def create_task_harvest(arg):
     collection_name = arg.get('collection_name')
     harvest_aurehal = arg.get('harvest_aurehal', True)
     min_year = arg.get('min_year', 1000)
+    nb_workers = arg.get('nb_workers')
+    max_requests_per_second = arg.get('max_requests_per_second')
+    full_raw = arg.get('full_raw', False)
+    incremental = arg.get('incremental', False)
+    resume = arg.get('resume', False)
+    target_window_size = arg.get('target_window_size')
+    reuse_plan = arg.get('reuse_plan', False)
+    nb_parse_processes = arg.get('nb_parse_processes')
+    aurehal_store = arg.get('aurehal_store')
+    merge = arg.get('merge', False)
+    chunk_format = arg.get('chunk_format')
+    parquet_partition = arg.get('parquet_partition')
+    aurehal_from = arg.get('aurehal_from')
     if collection_name:
-        harvest_and_insert(collection_name, harvest_aurehal, min_year)
-
-#    url_hal_update = "https://api.archives-ouvertes.fr/search/?fq=doiId_s:*%20AND%20structCountry_s:fr%20AND%20modifiedDate_tdate:[{0}T00:00:00Z%20TO%20{1}T00:00:00Z]%20AND%20producedDate_tdate:[2013-01-01T00:00:00Z%20TO%20{1}T00:00:00Z]&fl=halId_s,doiId_s,openAccess_bool&rows={2}&start={3}"
+        harvest_and_insert(collection_name, harvest_aurehal, min_year, nb_workers, max_requests_per_second, full_raw, incremental, resume,
+                           target_window_size, reuse_plan, nb_parse_processes, aurehal_store, merge, chunk_format,
+                           parquet_partition, aurehal_from)
 
 def create_task_load_collection_from_object_storage(args):
     collection_name = args.get('collection_name')
+    merge = args.get('merge', False)
+    nb_workers = args.get('nb_workers')
+    if collection_name:
+        load_collection_from_object_storage(collection_name, merge, nb_workers)
+
+def create_task_export_parquet(args):
+    collection_name = args.get('collection_name')
+    partition_by = args.get('partition_by', 'year')
     if collection_name:
-        load_collection_from_object_storage(collection_name)
+        export_collection_to_parquet(collection_name, partition_by)
@@ -1,15 +1,34 @@
+import bz2
+import codecs
 import gzip
+import itertools
+import json
+import lzma
 import os
-import pandas as pd
 import swiftclient
+import tempfile
+import threading
+import zlib
 
-from io import BytesIO, TextIOWrapper
+from concurrent.futures import Future, ThreadPoolExecutor
 from retry import retry
 
 from project.server.main.logger import get_logger
 
 logger = get_logger(__name__)
 SWIFT_SIZE = 10000
+SWIFT_SEGMENT_SIZE = int(os.getenv('SWIFT_SEGMENT_SIZE', 1048576000))
+SWIFT_UPLOAD_WORKERS = int(os.getenv('SWIFT_UPLOAD_WORKERS', 4))
+SWIFT_UPLOAD_QUEUE_SIZE = int(os.getenv('SWIFT_UPLOAD_QUEUE_SIZE', 8))
+STREAM_BUFFER_SIZE = 1024 * 1024
+# longest JSON token a block can cut before the decoder fails on it, as -Infinity or a \uXXXX\uXXXX surrogate pair
+MAX_CUT_TOKEN_SIZE = 12
+STORAGE_ERRORS = (swiftclient.ClientException, OSError)
+COMPRESSORS = {
+    'gzip': lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+    'bz2': lambda: bz2.BZ2Compressor(),
+    'xz': lambda: lzma.LZMACompressor(),
+}
 key = os.getenv('OS_PASSWORD')
 project_name = os.getenv('OS_PROJECT_NAME')
 project_id = os.getenv('OS_TENANT_ID')
@@ -24,11 +43,14 @@ init_cmd = f"swift --os-auth-url https://auth.cloud.ovh.net/v3 --auth-version 3
       --os-project-id {project_id} \
       --os-project-name {project_name} \
       --os-region-name GRA"
-conn = None
+local = threading.local()
+upload_executor = ThreadPoolExecutor(max_workers=SWIFT_UPLOAD_WORKERS)
+upload_slots = threading.BoundedSemaphore(SWIFT_UPLOAD_WORKERS + SWIFT_UPLOAD_QUEUE_SIZE)
 
 
 def get_connection() -> swiftclient.Connection:
-    global conn
+    # swiftclient connections are not thread-safe: one per thread, authenticated once and then reused
+    conn = getattr(local, 'conn', None)
     if conn is None:
         conn = swiftclient.Connection(
             authurl='https://auth.cloud.ovh.net/v3',
@@ -43,18 +65,130 @@ def get_connection() -> swiftclient.Connection:
             },
             auth_version='3'
         )
+        local.conn = conn
     return conn
 
 
-@retry(delay=2, tries=50)
+def submit_upload(func, *args, **kwargs) -> Future:
+    # runs an upload in the background; blocks when too many are already pending, so that the data they hold stays bounded
+    upload_slots.acquire()
+    try:
+        future = upload_executor.submit(func, *args, **kwargs)
+    except Exception:
+        upload_slots.release()
+        raise
+    future.add_done_callback(lambda f: upload_slots.release())
+    return future
+
+
+def upload_segments(connection: swiftclient.Connection, container: str, source: str, target: str, size: int) -> None:
+    # files bigger than a segment are stored as a static large object, like the swift CLI does
+    segments_container = f'{container}_segments'
+    connection.put_container(segments_container)
+    manifest = []
+    with open(source, 'rb') as f:
+        for ix, offset in enumerate(range(0, size, SWIFT_SEGMENT_SIZE)):
+            length = min(SWIFT_SEGMENT_SIZE, size - offset)
+            segment = f'{target}/{ix:08d}'
+            f.seek(offset)
+            etag = connection.put_object(segments_container, segment, contents=f, content_length=length)
+            manifest.append({'path': f'/{segments_container}/{segment}', 'etag': etag, 'size_bytes': length})
+    connection.put_object(container, target, contents=json.dumps(manifest), query_string='multipart-manifest=put')
+
+
+@retry(delay=2, tries=50, logger=logger)
 def upload_object(container: str, source: str, target: str) -> str:
     logger.debug(f'Uploading {source} in {container} as {target}')
-    cmd = init_cmd + f' upload {container} {source} --object-name {target}' \
-                     f' --segment-size 1048576000 --segment-threads 100'
-    os.system(cmd)
+    connection = get_connection()
+    size = os.path.getsize(source)
+    if size > SWIFT_SEGMENT_SIZE:
+        upload_segments(connection, container, source, target, size)
+    else:
+        with open(source, 'rb') as f:
+            connection.put_object(container, target, contents=f, content_length=size)
+    return f'https://storage.gra.cloud.ovh.net/v1/AUTH_{project_id}/{container}/{target}'
+
+
+def iter_json(data, depth: int = 1):
+    # JSON text of a list or dict, one element at a time, nested lists and dicts being streamed down to depth
+    if depth > 0 and isinstance(data, dict):
+        yield '{'
+        for ix, (k, v) in enumerate(data.items()):
+            yield (', ' if ix else '') + json.dumps(str(k)) + ': '
+            yield from iter_json(v, depth - 1)
+        yield '}'
+    elif depth > 0 and isinstance(data, list):
+        yield '['
+        for ix, elt in enumerate(data):
+            if ix:
+                yield ', '
+            yield from iter_json(elt, depth - 1)
+        yield ']'
+    else:
+        yield json.dumps(data)
+
+
+def iter_jsonl(data):
+    # JSON lines text of a list, one element per line
+    for elt in data:
+        yield json.dumps(elt) + '\n'
+
+
+def compress_json(data, codec: str = 'gzip', depth: int = 1, lines: bool = False):
+    # streams the compressed JSON (or JSON lines) in blocks, nothing is written to the local disk
+    compressor = COMPRESSORS[codec]()
+    buffer, size = [], 0
+    for piece in (iter_jsonl(data) if lines else iter_json(data, depth)):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= STREAM_BUFFER_SIZE:
+            block = compressor.compress(''.join(buffer).encode('utf-8'))
+            buffer, size = [], 0
+            if block:
+                yield block
+    yield compressor.compress(''.join(buffer).encode('utf-8')) + compressor.flush()
+
+
+@retry(delay=2, tries=50, logger=logger)
+def upload_json(container: str, data, target: str, codec: str = 'gzip', depth: int = 1, lines: bool = False) -> str:
+    logger.debug(f'Uploading {len(data)} elements in {container} as {target}')
+    connection = get_connection()
+    connection.put_object(container, target, contents=compress_json(data, codec, depth, lines))
     return f'https://storage.gra.cloud.ovh.net/v1/AUTH_{project_id}/{container}/{target}'
 
 
+@retry(delay=2, tries=50, logger=logger)
+def upload_content(container: str, content: bytes, target: str) -> str:
+    logger.debug(f'Uploading {len(content)} bytes in {container} as {target}')
+    connection = get_connection()
+    connection.put_object(container, target, contents=content)
+    return f'https://storage.gra.cloud.ovh.net/v1/AUTH_{project_id}/{container}/{target}'
+
+
+@retry(delay=2, tries=50)
+def get_json_object(container: str, path: str, default=None):
+    # a small gzipped JSON object (e.g. a harvest state), or default if it does not exist yet
+    connection = get_connection()
+    try:
+        content = connection.get_object(container, path)[1]
+    except swiftclient.ClientException as e:
+        if e.http_status == 404:
+            return default
+        raise
+    return json.loads(gzip.decompress(content))
+
+
+@retry(delay=2, tries=50)
+def delete_objects(container: str, paths: list) -> None:
+    connection = get_connection()
+    for path in paths:
+        try:
+            connection.delete_object(container, path)
+        except swiftclient.ClientException as e:
+            if e.http_status != 404:
+                raise
+
+
 @retry(delay=2, tries=50)
 def download_object(container: str, filename: str, out: str) -> None:
     logger.debug(f'Downloading {filename} from {container} to {out}')
@@ -63,27 +197,178 @@ def download_object(container: str, filename: str, out: str) -> None:
 
 
 @retry(delay=2, tries=50)
-def get_objects(container: str, path: str) -> list:
+def get_etag(container: str, path: str):
+    # etag of an object, or None if it does not exist
+    connection = get_connection()
     try:
-        connection = get_connection()
-        df = pd.read_json(BytesIO(connection.get_object(
-            container, path)[1]), compression='gzip')
-    except:
-        df = pd.DataFrame([])
-    return df.to_dict('records')
+        return connection.head_object(container, path)['etag']
+    except swiftclient.ClientException as e:
+        if e.http_status == 404:
+            return None
+        raise
+
+
+def write_atomically(out: str, chunks) -> None:
+    # written to a temporary file unique to this process and then moved, so that several workers sharing a directory
+    # never interleave their writes, and readers of a previous copy of out keep it
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(out) or '.', prefix=f'{os.path.basename(out)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp, out)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+@retry(exceptions=STORAGE_ERRORS, delay=2, tries=50)
+def download_file(container: str, path: str, out: str) -> str:
+    # returns the etag of the downloaded object
+    logger.debug(f'Downloading {path} from {container} to {out}')
+    connection = get_connection()
+    headers, chunks = connection.get_object(container, path, resp_chunk_size=STREAM_BUFFER_SIZE)
+    write_atomically(out, chunks)
+    return headers['etag']
+
+
+def read_etag(out: str):
+    if not os.path.exists(out) or not os.path.exists(f'{out}.etag'):
+        return None
+    with open(f'{out}.etag', 'r') as f:
+        return f.read()
+
+
+def get_cached_file(container: str, path: str, out: str):
+    # local copy of an object, downloaded again only when its etag changed; None if the object does not exist
+    etag = get_etag(container, path)
+    if etag is None:
+        return None
+    if read_etag(out) == etag:
+        logger.debug(f'{out} is up to date with {container}/{path}')
+        return out
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    etag = download_file(container, path, out)
+    # the etag is only written once the file is in place, a copy without a matching etag is downloaded again
+    write_atomically(f'{out}.etag', [etag.encode('utf-8')])
+    return out
+
+
+def iter_decompressed(chunks):
+    # text of a gzipped byte stream, one block at a time
+    # (concatenated gzip files are several members in a row, each one read with its own decompressor, as gunzip does)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in chunks:
+        while chunk:
+            if decompressor.eof:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            yield decoder.decode(decompressor.decompress(chunk))
+            chunk = decompressor.unused_data if decompressor.eof else b''
+    yield decoder.decode(decompressor.flush(), final=True)
+    if not decompressor.eof:
+        raise ValueError('truncated gzip stream')
+
+
+def iter_json_array(blocks):
+    # elements of a JSON array read from blocks of text, decoded one at a time as soon as they are complete,
+    # so that only one element and one block are held at once
+    decoder = json.JSONDecoder()
+    buffer, pos, expected = '', 0, '['
+    for block in blocks:
+        buffer = buffer[pos:] + block
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos == len(buffer):
+                break
+            char = buffer[pos]
+            if expected == '[' and char == '[':
+                expected = 'first'
+            elif expected in ('first', 'next') and char == ']':
+                return
+            elif expected == 'next' and char == ',':
+                expected = 'element'
+            elif expected in ('first', 'element'):
+                try:
+                    element, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError as e:
+                    # an element cut by the end of the block fails on its last token, or on a string left open,
+                    # any other error is a corrupt element, not worth buffering the rest of the array for
+                    if e.pos < len(buffer) - MAX_CUT_TOKEN_SIZE and not e.msg.startswith('Unterminated string'):
+                        raise ValueError(f'invalid JSON array element near {buffer[e.pos:e.pos + 20]!r}') from e
+                    end = len(buffer)
+                if end == len(buffer):
+                    # an element cut by the end of the block, wait for the next one
+                    break
+                yield element
+                pos, expected = end, 'next'
+                continue
+            else:
+                raise ValueError(f'invalid JSON array near {buffer[pos:pos + 20]!r}')
+            pos += 1
+    raise ValueError(f'truncated JSON array near {buffer[pos:pos + 20]!r}')
+
+
+def iter_jsonl_records(blocks):
+    # elements of a JSON lines text read from blocks of text, one line at a time
+    buffer = ''
+    for block in blocks:
+        lines = (buffer + block).split('\n')
+        buffer = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if buffer.strip():
+        yield json.loads(buffer)
+
+
+def iter_records(blocks):
+    # a JSON array or JSON lines, told apart by their first character
+    blocks = iter(blocks)
+    first = ''
+    for block in blocks:
+        first += block
+        if first.strip():
+            break
+    blocks = itertools.chain([first], blocks)
+    if first.lstrip().startswith('['):
+        return iter_json_array(blocks)
+    return iter_jsonl_records(blocks)
+
+
+def iter_objects(container: str, path: str):
+    # records of a gzipped JSON array or JSON lines object, streamed from the object storage; corrupt objects raise
+    # (only STORAGE_ERRORS are worth retrying, decoding errors are raised as is)
+    connection = get_connection()
+    chunks = connection.get_object(container, path, resp_chunk_size=STREAM_BUFFER_SIZE)[1]
+    yield from iter_records(iter_decompressed(chunks))
+
+
+@retry(exceptions=STORAGE_ERRORS, delay=2, tries=50)
+def get_objects(container: str, path: str) -> list:
+    return list(iter_objects(container, path))
 
 
 @retry(delay=2, tries=50)
-def get_paths_by_prefix(container: str, prefix: str) -> list:
-    logger.debug(
-        f'Retrieving paths from container {container} and prefix {prefix}')
+def get_container_page(container: str, prefix: str, marker: str = None, limit: int = SWIFT_SIZE, delimiter: str = None) -> list:
+    connection = get_connection()
+    return connection.get_container(container=container, marker=marker, limit=limit, prefix=prefix, delimiter=delimiter)[1]
+
+
+def list_objects(container: str, prefix: str, delimiter: str = None, limit: int = SWIFT_SIZE):
+    # yields {'name', 'bytes', ...} for every object under prefix, page after page, as soon as each page is listed
+    # with a delimiter, the "directories" right under prefix are yielded as {'subdir': ...} instead of their content
+    logger.debug(f'Listing objects from container {container} and prefix {prefix}')
     marker = None
-    keep_going = True
-    filenames = []
-    while keep_going:
-        connection = get_connection()
-        content = connection.get_container(
-            container=container, marker=marker, prefix=prefix)[1]
-        filenames += [file['name'] for file in content]
-        keep_going = len(content) == SWIFT_SIZE
-    return filenames
+    while True:
+        content = get_container_page(container, prefix, marker=marker, limit=limit, delimiter=delimiter)
+        yield from content
+        if len(content) < limit:
+            return
+        marker = content[-1].get('name', content[-1].get('subdir'))
+
+
+def get_paths_by_prefix(container: str, prefix: str) -> list:
+    return [obj['name'] for obj in list_objects(container, prefix)]
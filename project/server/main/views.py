@@ -2,7 +2,7 @@ import redis
 from rq import Queue, Connection
 from flask import render_template, Blueprint, jsonify, request, current_app
 
-from project.server.main.tasks import create_task_harvest, create_task_load_collection_from_object_storage
+from project.server.main.tasks import create_task_export_parquet, create_task_harvest, create_task_load_collection_from_object_storage
 
 main_blueprint = Blueprint("main", __name__,)
 from project.server.main.logger import get_logger
@@ -45,6 +45,21 @@ def run_task_load_collection_from_object_storage():
     return jsonify(response_object), 202
 
 
+@main_blueprint.route("/export_parquet", methods=["POST"])
+def run_task_export_parquet():
+    args = request.get_json(force=True)
+    with Connection(redis.from_url(current_app.config["REDIS_URL"])):
+        q = Queue(queue_name, default_timeout=216000)
+        task = q.enqueue(create_task_export_parquet, args)
+    response_object = {
+        "status": "success",
+        "data": {
+            "task_id": task.get_id()
+        }
+    }
+    return jsonify(response_object), 202
+
+
 @main_blueprint.route("/tasks/<task_id>", methods=["GET"])
 def get_status(task_id):
     with Connection(redis.from_url(current_app.config["REDIS_URL"])):
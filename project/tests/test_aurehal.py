@@ -0,0 +1,109 @@
+import os
+import tempfile
+import unittest
+
+from unittest import mock
+
+from project.server.main.aurehal import AurehalStore, build_aurehal_store, create_docid_map, get_aurehal, get_temporary_file, patch_docid_map,\
+    read_aurehal
+
+ENTITIES = [{'hal_docid': '1', 'name': 'Lab 1'}, {'hal_docid': '3', 'name': 'Lab 3'}]
+DOCIDS = [['1'], ['3', '30']]
+
+
+class TestAurehalStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'aurehal_structure_map.sqlite')
+        build_aurehal_store(ENTITIES, DOCIDS, self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_same_lookups_as_a_dict(self):
+        store = AurehalStore(self.path)
+        self.assertEqual(len(store), 3)
+        self.assertIn('30', store)
+        self.assertEqual(store['30'], ENTITIES[1])
+        self.assertEqual(store.get(1), ENTITIES[0])
+        self.assertNotIn('2', store)
+        self.assertIsNone(store.get('2'))
+        with self.assertRaises(KeyError):
+            store['2']
+
+    def test_a_docid_is_queried_once(self):
+        store = AurehalStore(self.path)
+        queries = []
+        store.get_connection().set_trace_callback(queries.append)
+        for _ in range(3):
+            for docid in ['1', '30', '2']:
+                if docid in store:
+                    store[docid]
+                store.get(docid)
+        self.assertEqual(len(queries), 3)
+
+
+class TestWorkingFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_spill_files_are_unique(self):
+        with mock.patch('project.server.main.aurehal.get_aurehal_page', return_value=([{'docid': 1}], '*')):
+            first, second = get_aurehal('structure'), get_aurehal('structure')
+        self.assertNotEqual(first, second)
+        self.assertEqual(list(read_aurehal(first)), [{'docid': 1}])
+
+    def test_spill_file_is_removed_when_the_harvest_fails(self):
+        with mock.patch('project.server.main.aurehal.get_aurehal_page', side_effect=[([{'docid': 1}], 'next'), RuntimeError('HAL down')]):
+            with self.assertRaises(RuntimeError):
+                get_aurehal('structure')
+        self.assertEqual(os.listdir('.'), [])
+
+    def test_store_is_built_in_a_new_temporary_file(self):
+        path = get_temporary_file('aurehal_structure_map.sqlite')
+        build_aurehal_store(ENTITIES, DOCIDS, path)
+        self.assertEqual(AurehalStore(path)['30'], ENTITIES[1])
+
+
+class TestPatchDocidMap(unittest.TestCase):
+
+    def setUp(self):
+        self.entities, self.docids = create_docid_map([{'docid': 1, 'name_s': 'Lab 1'}, {'docid': 2, 'name_s': 'Lab 2'},
+                                                       {'docid': 3, 'name_s': 'Lab 3', 'aliasDocid_i': [30]}], 'structure', {})
+
+    def patch(self, records):
+        entities, docids = patch_docid_map(self.entities, self.docids, records, 'structure', {})
+        return {entity['hal_docid']: (entity['name'], row_docids) for entity, row_docids in zip(entities, docids)}
+
+    def test_add(self):
+        self.assertEqual(self.patch([{'docid': 4, 'name_s': 'Lab 4'}]),
+                         {'1': ('Lab 1, ', ['1']), '2': ('Lab 2, ', ['2']), '3': ('Lab 3, ', ['3', '30']), '4': ('Lab 4, ', ['4'])})
+
+    def test_update(self):
+        self.assertEqual(self.patch([{'docid': 2, 'name_s': 'New lab 2'}]),
+                         {'1': ('Lab 1, ', ['1']), '2': ('New lab 2, ', ['2']), '3': ('Lab 3, ', ['3', '30'])})
+
+    def test_merge(self):
+        # 2 merged into 1 becomes one of its aliases, and its row is dropped
+        self.assertEqual(self.patch([{'docid': 1, 'name_s': 'Lab 1', 'aliasDocid_i': [2]}]),
+                         {'1': ('Lab 1, ', ['1', '2']), '3': ('Lab 3, ', ['3', '30'])})
+
+    def test_alias_removal(self):
+        self.assertEqual(self.patch([{'docid': 3, 'name_s': 'Lab 3'}]),
+                         {'1': ('Lab 1, ', ['1']), '2': ('Lab 2, ', ['2']), '3': ('Lab 3, ', ['3'])})
+
+    def test_alias_reassignment(self):
+        self.assertEqual(self.patch([{'docid': 4, 'name_s': 'Lab 4', 'aliasDocid_i': [30]}]),
+                         {'1': ('Lab 1, ', ['1']), '2': ('Lab 2, ', ['2']), '3': ('Lab 3, ', ['3']), '4': ('Lab 4, ', ['30', '4'])})
+
+    def test_record_of_an_alias_does_not_replace_its_entity(self):
+        self.assertEqual(self.patch([{'docid': 30, 'name_s': 'Lab 30'}]),
+                         {'1': ('Lab 1, ', ['1']), '2': ('Lab 2, ', ['2']), '3': ('Lab 3, ', ['3']), '30': ('Lab 30, ', ['30'])})
@@ -0,0 +1,57 @@
+import unittest
+
+from unittest import mock
+
+from project.server.main import feed
+
+CURRENT_RUN = {'harvest_start': '2024-01-02T00:00:00Z', 'incremental': False, 'min_year': 2020, 'full_raw': False,
+               'last_modified_date': '2024-01-01T00:00:00Z', 'chunk_format': 'json', 'parquet_partition': 'year', 'merge': True}
+
+
+class TestHarvestAndInsert(unittest.TestCase):
+
+    def harvest(self, state, **kwargs):
+        saved = []
+        with mock.patch.object(feed, 'get_harvest_state', return_value=state), \
+                mock.patch.object(feed, 'save_harvest_state', side_effect=lambda name, s: saved.append(dict(s))), \
+                mock.patch.object(feed, 'get_aurehal_from_OS', return_value={}), \
+                mock.patch.object(feed, 'get_harvest_plan', return_value={'windows': [{'start': '2020', 'end': '2020'}]}), \
+                mock.patch.object(feed, 'start_parse_pool'), mock.patch.object(feed, 'stop_parse_pool'), \
+                mock.patch.object(feed, 'drop_collection') as drop_collection, \
+                mock.patch.object(feed, 'clear_checkpoints'), mock.patch.object(feed, 'clear_chunks') as clear_chunks, \
+                mock.patch.object(feed, 'harvest_windows') as harvest_windows, \
+                mock.patch.object(feed, 'export_collection_to_parquet') as export_collection_to_parquet:
+            feed.harvest_and_insert('c', harvest_aurehal=False, **kwargs)
+        return saved, drop_collection, clear_chunks, harvest_windows, export_collection_to_parquet
+
+    def test_a_new_run_records_merge(self):
+        saved = self.harvest({}, merge=True, parquet_partition='year')[0]
+        self.assertTrue(saved[0]['current_run']['merge'])
+
+    def test_a_resumed_merge_still_rebuilds_the_parquet_dataset(self):
+        _, drop_collection, clear_chunks, harvest_windows, export_collection_to_parquet = \
+            self.harvest({'current_run': dict(CURRENT_RUN)}, resume=True)
+        # merge is taken from the interrupted run, not from the task
+        self.assertTrue(harvest_windows.call_args[0][7])
+        self.assertIsNone(harvest_windows.call_args[0][9])
+        export_collection_to_parquet.assert_called_once_with('c', 'year')
+        drop_collection.assert_not_called()
+        # the chunks of the previous plans, older than the interrupted run, are removed once it is done
+        clear_chunks.assert_called_once_with('c', before=CURRENT_RUN['harvest_start'])
+
+    def test_an_incremental_merge_keeps_the_previous_chunks(self):
+        state = {'last_modified_date': '2024-01-01T00:00:00Z'}
+        clear_chunks = self.harvest(state, merge=True, incremental=True)[2]
+        clear_chunks.assert_not_called()
+
+
+class TestClearChunks(unittest.TestCase):
+
+    def test_only_chunks_written_before_are_removed(self):
+        objects = [{'name': 'c/parsed/hal_parsed_2020_0.json.gz', 'last_modified': '2024-01-01T23:59:59.999999'},
+                   {'name': 'c/parsed/hal_parsed_2020_2021_0.json.gz', 'last_modified': '2024-01-02T00:00:00.000001'}]
+        with mock.patch.object(feed, 'list_objects', side_effect=lambda container, prefix: [o for o in objects if o['name'].startswith(prefix)]), \
+                mock.patch.object(feed, 'delete_objects') as delete_objects:
+            feed.clear_chunks('c', before='2024-01-02T00:00:00Z')
+        self.assertIn(mock.call('hal', ['c/parsed/hal_parsed_2020_0.json.gz']), delete_objects.call_args_list)
+        self.assertNotIn('c/parsed/hal_parsed_2020_2021_0.json.gz', [p for c in delete_objects.call_args_list for p in c[0][1]])
@@ -0,0 +1,41 @@
+import unittest
+
+from concurrent.futures import Future
+from io import BytesIO
+from unittest import mock
+
+import pyarrow.parquet as pq
+
+from project.server.main.parquet import export_collection_to_parquet
+
+
+def publication(hal_id, year, journal_name):
+    return {'hal_id': hal_id, 'year': year, 'journal_name': journal_name,
+            'oa_details': {'2024Q1': {'is_oa': True, 'snapshot_date': '20240101', 'observation_date': '2024Q1'}}}
+
+
+class TestExportCollectionToParquet(unittest.TestCase):
+
+    def test_publications_harvested_again_are_only_kept_from_the_most_recent_chunk(self):
+        chunks = {
+            'c/parsed/hal_parsed_2020_0.json.gz': [publication('hal-1', '2020', 'old'), publication('hal-2', '2020', 'kept')],
+            'c/parsed/hal_parsed_modified_2024_0.json.gz': [publication('hal-1', '2020', 'new')],
+        }
+        listing = [{'name': 'c/parsed/hal_parsed_2020_0.json.gz', 'last_modified': '2024-01-01T00:00:00'},
+                   {'name': 'c/parsed/hal_parsed_modified_2024_0.json.gz', 'last_modified': '2024-02-01T00:00:00'}]
+        uploads = {}
+
+        def submit_upload(func, container, content, target):
+            uploads[target] = pq.read_table(BytesIO(content)).to_pylist()
+            future = Future()
+            future.set_result(target)
+            return future
+        with mock.patch('project.server.main.parquet.list_objects', return_value=listing), \
+                mock.patch('project.server.main.parquet.get_paths_by_prefix', return_value=['c/parquet/year=2020/stale.parquet']), \
+                mock.patch('project.server.main.parquet.delete_objects') as delete_objects, \
+                mock.patch('project.server.main.parquet.iter_objects', side_effect=lambda container, path: iter(chunks[path])), \
+                mock.patch('project.server.main.parquet.submit_upload', side_effect=submit_upload):
+            export_collection_to_parquet('c', 'year')
+        delete_objects.assert_called_once_with('hal', ['c/parquet/year=2020/stale.parquet'])
+        rows = sorted((row['hal_id'], row['journal_name']) for rows in uploads.values() for row in rows)
+        self.assertEqual(rows, [('hal-1', 'new'), ('hal-2', 'kept')])
@@ -0,0 +1,218 @@
+import copy
+import datetime
+import fcntl
+import gc
+import gzip
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from dateutil import parser
+
+from project.server.main.aurehal import AurehalMap, AurehalStore, build_aurehal_store, create_docid_map, parse_author, parse_structure
+from project.server.main.fields import HAL_DATE_FIELDS
+from project.server.main.parse import evict_aurehal_snapshots, get_repository, lock_aurehal_snapshot, parse_date_cached, parse_hal, parse_hal_chunk, \
+    start_parse_pool, stop_parse_pool
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'benchmarks', 'fixtures')
+RECORDED_NOTICES_FILE = os.path.join(os.path.dirname(__file__), '..', '..', 'notebooks', 'xxx.json')
+SNAPSHOT_DATE = '20240101'
+
+
+def load_fixture(name):
+    with gzip.open(os.path.join(FIXTURES_DIR, f'{name}.json.gz'), 'rt') as f:
+        return json.load(f)
+
+
+def get_aurehal():
+    structures = load_fixture('aurehal_structure')
+    authors = load_fixture('aurehal_author')
+    _, structure_docids = create_docid_map(structures, 'structure', {})
+    _, author_docids = create_docid_map(authors, 'author', {})
+    return {'structure': AurehalMap([parse_structure(s) for s in structures], structure_docids),
+            'author': AurehalMap([parse_author(a, {}) for a in authors], author_docids)}
+
+
+class TestParseHalChunk(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.notices = load_fixture('hal_notices')
+        cls.aurehal = get_aurehal()
+
+    def test_pool_and_in_process_give_the_same_output(self):
+        in_process = json.loads(json.dumps(parse_hal_chunk(self.notices, self.aurehal, SNAPSHOT_DATE)))
+        start_parse_pool(self.aurehal, 2)
+        try:
+            in_pool = json.loads(json.dumps(parse_hal_chunk(self.notices, self.aurehal, SNAPSHOT_DATE)))
+        finally:
+            stop_parse_pool()
+        self.assertEqual(len(in_process), len(self.notices))
+        self.assertEqual(in_process, in_pool)
+
+    def test_referential_entities_are_not_modified(self):
+        entities = copy.deepcopy(self.aurehal['structure'].entities), copy.deepcopy(self.aurehal['author'].entities)
+        parse_hal_chunk(self.notices, self.aurehal, SNAPSHOT_DATE)
+        self.assertEqual(entities, (self.aurehal['structure'].entities, self.aurehal['author'].entities))
+
+
+class TestAurehalAliases(unittest.TestCase):
+
+    def test_affiliation_keeps_the_structId_of_the_notice(self):
+        # 2 is an alias of 1, both ids lead to the same entity of the map
+        aurehal = {'structure': AurehalMap([parse_structure({'docid': 1, 'aliasDocid_i': [2], 'name_s': 'Lab'})], [['1', '2']]),
+                   'author': AurehalMap([], [])}
+        by_id = parse_hal({'halId_s': 'hal-1', 'structId_i': [1]}, aurehal, SNAPSHOT_DATE)
+        by_alias = parse_hal({'halId_s': 'hal-2', 'structId_i': [2]}, aurehal, SNAPSHOT_DATE)
+        self.assertEqual(by_id['affiliations'][0]['structId'], '1')
+        self.assertEqual(by_alias['affiliations'][0]['structId'], '2')
+        self.assertNotIn('structId', aurehal['structure']['1'])
+
+
+
+class TestParseDate(unittest.TestCase):
+
+    def get_date_strings(self):
+        # the date fields of the notices recorded from HAL (all their date fields), and of the benchmark sample
+        dates = set()
+        with open(RECORDED_NOTICES_FILE, 'r') as f:
+            for notice in json.load(f):
+                dates.update(v for k, v in notice.items() if 'Date' in k and isinstance(v, str))
+        for name in ['hal_recorded', 'hal_notices']:
+            for notice in load_fixture(name):
+                dates.update(notice[f] for f in HAL_DATE_FIELDS if isinstance(notice.get(f), str))
+        # and formats only dateutil parses
+        dates.update(['2020/02', '02/2020', 'March 2020', '0999', '1990-01-01 08:00:00'])
+        return sorted(dates)
+
+    def test_same_result_as_dateutil(self):
+        dates = self.get_date_strings()
+        self.assertGreater(len(dates), 100)
+        # partial dates are completed with today, end of months and leap days included
+        for today in [datetime.date(2024, 1, 31), datetime.date(2024, 2, 29), datetime.date(2023, 6, 15)]:
+            default = datetime.datetime.combine(today, datetime.time())
+            for x in dates:
+                try:
+                    expected = parser.parse(x, default=default).isoformat()
+                except (ValueError, OverflowError):
+                    with self.assertRaises((ValueError, OverflowError), msg=x):
+                        parse_date_cached(x, today)
+                    continue
+                self.assertEqual(parse_date_cached(x, today), expected, msg=f'{x} on {today}')
+
+    def test_dateutil_fallback_completes_partial_dates_with_the_today_of_the_key(self):
+        # formats out of the fast path, completed with the day (or the month and day) of today
+        today = datetime.date(2001, 9, 30)
+        self.assertEqual(parse_date_cached('2020/02', today), '2020-02-29T00:00:00')
+        self.assertEqual(parse_date_cached('March 2020', today), '2020-03-30T00:00:00')
+        self.assertEqual(parse_date_cached('0999', today), '0999-09-30T00:00:00')
+
+
+
+def get_repository_before_rules(a_repo):
+    # get_repository before its rules were moved to repositories.json, kept as the reference
+    if a_repo.replace('www.', '')[0:3].lower() == 'hal':
+        return 'HAL'
+    for r in ['bioRxiv', 'medRxiv', 'arXiv', 'Research Square', 'Zenodo', 'Archimer', 'RePEc', 'CiteSeerX', 'univOAK']:
+        if r.lower().replace(' ', '') in a_repo.lower():
+            return r
+    if 'lilloa' in a_repo.lower():
+        return 'LillOA (Lille Open Archive)'
+    if 'ucl.ac.uk' in a_repo.lower():
+        return 'UCL Discovery'
+    if 'lirias' in a_repo.lower() and 'kuleuven' in a_repo.lower():
+        return 'LIRIAS (KU Leuven)'
+    if 'pure.atira.dk' in a_repo.lower():
+        return 'Pure (Denmark)'
+    if 'digital.csic.es' in a_repo.lower():
+        return 'DIGITAL.CSIC (Spain)'
+    if 'escholarship.org/ark' in a_repo.lower():
+        return 'California Digital Library - eScholarship'
+    if 'jupiter.its.unimelb.edu.au' in a_repo.lower():
+        return 'University of Melbourne - Minerva Access'
+    if 'helda.helsinki' in a_repo.lower():
+        return 'HELDA - Digital Repository of the University of Helsinki'
+    if 'osti.gov' in a_repo.lower():
+        return 'US Office of Scientific and Technical Information'
+    for f in ['pubmedcentral', 'ncbi.nlm.nih.gov/pmc', 'europepmc']:
+        if f in a_repo:
+            return 'PubMed Central'
+    return a_repo
+
+
+class TestGetRepository(unittest.TestCase):
+
+    def get_urls(self, nb_urls):
+        # the urls of the fixtures, and urls made of the fragments the rules look for, in any case and order
+        urls = [n['linkExtUrl_s'] for name in ['hal_recorded', 'hal_notices'] for n in load_fixture(name)
+                if isinstance(n.get('linkExtUrl_s'), str)]
+        fragments = ['hal', 'HAL', 'www.', 'https://', 'biorxiv', 'bioRxiv', 'medrxiv', 'arxiv.org', 'researchsquare', 'zenodo', 'archimer',
+                     'repec', 'citeseerx', 'univoak', 'lilloa', 'ucl.ac.uk', 'lirias', 'kuleuven', 'KULeuven', 'pure.atira.dk',
+                     'digital.csic.es', 'escholarship.org/ark', 'eScholarship.org/ARK', 'jupiter.its.unimelb.edu.au', 'helda.helsinki',
+                     'osti.gov', 'pubmedcentral', 'PubMedCentral', 'ncbi.nlm.nih.gov/pmc', 'NCBI.nlm.nih.gov/PMC', 'europepmc',
+                     'EuropePMC', 'example.org', '/', '.', 'ha', 'l', 'w']
+        rand = random.Random(0)
+        return urls + [''.join(rand.choice(fragments) for _ in range(rand.randint(1, 4))) for _ in range(nb_urls)]
+
+    def test_same_result_as_before_the_rules(self):
+        for url in self.get_urls(50000):
+            self.assertEqual(get_repository(url), get_repository_before_rules(url), msg=url)
+
+
+
+class TestEvictAurehalSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.snapshots = [os.path.join(self.directory.name, 'structure', snapshot_id) for snapshot_id in ['a', 'b', 'c']]
+        for ix, snapshot_dir in enumerate(self.snapshots):
+            os.makedirs(snapshot_dir)
+            os.utime(snapshot_dir, (time.time() - 100 + ix, time.time() - 100 + ix))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_snapshots_in_use_are_kept(self):
+        # a long harvest still uses the oldest snapshot, its threads opening their connections after the eviction
+        path = os.path.join(self.snapshots[0], 'aurehal_structure_map.sqlite')
+        build_aurehal_store([{'hal_docid': '1'}], [['1']], path)
+        store = AurehalStore(path, lock=lock_aurehal_snapshot(self.snapshots[0]))
+        current = lock_aurehal_snapshot(self.snapshots[2])
+        try:
+            evict_aurehal_snapshots(self.snapshots[2], keep=1)
+        finally:
+            os.close(current)
+        self.assertEqual([os.path.isdir(d) for d in self.snapshots], [True, False, True])
+        found = []
+        thread = threading.Thread(target=lambda: found.append('1' in store))
+        thread.start()
+        thread.join()
+        self.assertEqual(found, [True])
+        # once released, the snapshot is evicted as well
+        del store, thread
+        gc.collect()
+        evict_aurehal_snapshots(self.snapshots[2], keep=1)
+        self.assertEqual([os.path.isdir(d) for d in self.snapshots], [False, False, True])
+
+    def test_a_snapshot_evicted_while_waiting_for_its_lock_is_made_again(self):
+        eviction = os.open(self.snapshots[0], os.O_RDONLY)
+        fcntl.flock(eviction, fcntl.LOCK_EX)
+        locks = []
+        thread = threading.Thread(target=lambda: locks.append(lock_aurehal_snapshot(self.snapshots[0])))
+        thread.start()
+        time.sleep(0.2)
+        shutil.rmtree(self.snapshots[0])
+        os.close(eviction)
+        thread.join()
+        try:
+            self.assertTrue(os.path.samestat(os.fstat(locks[0]), os.stat(self.snapshots[0])))
+        finally:
+            os.close(locks[0])
+
+if __name__ == '__main__':
+    unittest.main()
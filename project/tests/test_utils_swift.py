@@ -0,0 +1,64 @@
+import gzip
+import json
+import unittest
+
+from project.server.main.utils_swift import compress_json, iter_decompressed, iter_json_array, iter_records
+
+RECORDS = [
+    {'halId_s': 'hal-00000001', 'title_s': ['Étude du été \U0001f600 "quoted" \\ path'], 'citationRef_i': -1.5e+10},
+    {'halId_s': 'hal-00000002', 'openAccess_bool': True, 'doiId_s': None, 'authIdHal_i': [12345, 67]},
+]
+
+
+def split(data, *positions):
+    bounds = [0, *positions, len(data)]
+    return [data[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+class TestIterDecompressed(unittest.TestCase):
+
+    def test_concatenated_members_are_all_read(self):
+        data = gzip.compress(b'{"a": 1}\n') + gzip.compress(b'{"b": 2}\n')
+        for position in range(len(data) + 1):
+            self.assertEqual(''.join(iter_decompressed(split(data, position))), '{"a": 1}\n{"b": 2}\n')
+
+    def test_truncated_stream_raises(self):
+        data = gzip.compress(b'{"a": 1}\n')
+        with self.assertRaises(ValueError):
+            ''.join(iter_decompressed([data[:-4]]))
+
+
+class TestIterJsonArray(unittest.TestCase):
+
+    def test_elements_cut_anywhere_are_decoded(self):
+        text = json.dumps(RECORDS)
+        for first in range(len(text) + 1):
+            for second in range(first, len(text) + 1, 7):
+                self.assertEqual(list(iter_json_array(split(text, first, second))), RECORDS)
+
+    def test_corrupt_element_raises_without_reading_the_rest(self):
+        read = []
+
+        def blocks():
+            for block in ['[{"a": 1}, {"a": tru}, ', '{"a": 2}' + ' ' * 100, ', {"a": 3}]']:
+                read.append(block)
+                yield block
+        with self.assertRaisesRegex(ValueError, 'invalid JSON array element'):
+            list(iter_json_array(blocks()))
+        self.assertEqual(len(read), 2)
+
+    def test_truncated_array_raises(self):
+        with self.assertRaisesRegex(ValueError, 'truncated JSON array'):
+            list(iter_json_array(['[{"a": 1}, {"a": "unterminated']))
+
+
+class TestIterRecords(unittest.TestCase):
+
+    def test_json_and_json_lines_give_the_same_records(self):
+        for lines in [False, True]:
+            data = b''.join(compress_json(RECORDS, lines=lines))
+            self.assertEqual(list(iter_records(iter_decompressed(split(data, len(data) // 2)))), RECORDS)
+
+    def test_concatenated_json_lines_chunks_are_one_chunk(self):
+        chunks = [b''.join(compress_json(RECORDS[:1], lines=True)), b''.join(compress_json(RECORDS[1:], lines=True))]
+        self.assertEqual(list(iter_records(iter_decompressed([b''.join(chunks)]))), RECORDS)